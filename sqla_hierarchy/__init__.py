@@ -1 +1,12 @@
 from hierarchy import *
+from subtree import *
+from export import *
+from orm import *
+from instrument import *
+from ancestry import *
+from batch import *
+from incremental import *
+from planner import *
+from scanner import *
+from nested import *
+from snapshot import *
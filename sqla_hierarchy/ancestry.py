@@ -0,0 +1,115 @@
+# -*- coding: UTF-8 -*-
+"""Ancestor/descendant checks that walk up from a node instead of building
+the whole subtree"""
+
+from sqlalchemy.sql import text
+
+from subtree import _prepare, _sql_values
+
+__all__ = ['is_descendant', 'are_descendants', 'path_between',
+           'lowest_common_ancestor']
+
+def _ancestors_sql(dialect, table, parent, child, count):
+    """Build the sql text returning (origin, node, node_parent) for every
+    node met walking up from the :x_N nodes, N in range(count).
+    For pgsql the recursion stops as soon as the :y_N node (or a root) is
+    reached, so each walk costs at most the depth of the tree. It uses a
+    plain union (not union all) so a cycle can't loop forever.
+    For oracle (no recursive with before 11gR2) we use connect by from every
+    :x_N up to the roots."""
+    values = _sql_values(dialect, table, parent, child)
+    if dialect.name == 'postgresql':
+        coltype = dialect.type_compiler.process(table.c[child].type)
+        values['pairs'] = ", ".join(
+            ["(cast(:x_%d as %s), cast(:y_%d as %s))" % (ev, coltype, ev,
+                                                        coltype) \
+             for ev in range(count)])
+        return "with recursive pairs(origin, target) as (values "\
+               "%(pairs)s), up(origin, target, node, node_parent) as ("\
+               "select p.origin, p.target, hr.%(child)s, hr.%(parent)s "\
+               "from pairs p, %(tb)s hr where hr.%(child)s=p.origin "\
+               "union select up.origin, up.target, hr.%(child)s, "\
+               "hr.%(parent)s from up, %(tb)s hr where hr.%(child)s="\
+               "up.node_parent and (up.target is null or up.node<>"\
+               "up.target)) select origin, node, node_parent from up" % \
+               values
+    elif dialect.name == 'oracle':
+        values['starts'] = ", ".join([":x_%d" % ev for ev in range(count)])
+        return "select connect_by_root %(child)s as origin, %(child)s as "\
+               "node, %(parent)s as node_parent from %(tb)s start with "\
+               "%(child)s in (%(starts)s) connect by nocycle prior "\
+               "%(parent)s=%(child)s" % values
+    raise(NotImplementedError("This method hasn't been written "
+                              "for %s dialect yet" % (dialect.name)))
+
+def _chains(Session, table, pairs):
+    """Walk up from every x in `pairs` (a list of (x, y) tuples, y may be
+    None to walk up to the root) in a single round trip. It returns a list
+    with one chain per pair, in the same order: the ids from x upwards (x
+    included) stopping at y, empty if x doesn't exist. The same x may come
+    in several pairs, each with its own y."""
+    dialect, parent, child = _prepare(Session, table)
+    params = {}
+    for pos, (x, y) in enumerate(pairs):
+        params['x_%d' % pos] = x
+        params['y_%d' % pos] = y
+    qry = _ancestors_sql(dialect, table, parent, child, len(pairs))
+    parents = {}
+    for origin, node, node_parent in Session.execute(text(qry), params):
+        parents.setdefault(origin, {})[node] = node_parent
+    chains = []
+    for x, y in pairs:
+        chain = []
+        up = parents.get(x, {})
+        node = x
+        while node in up and node not in chain:
+            chain.append(node)
+            if node == y:
+                break
+            node = up[node]
+        chains.append(chain)
+    return chains
+
+def are_descendants(Session, table, pairs):
+    """Batched version of is_descendant: for a list of (x, y) tuples it
+    returns a list of booleans (one per tuple, in the same order) using a
+    single statement"""
+    if not pairs:
+        return []
+    pairs = list(pairs)
+    chains = _chains(Session, table, pairs)
+    return [y in chain[1:] for (x, y), chain in zip(pairs, chains)]
+
+def is_descendant(Session, table, x, y):
+    """Return True if node `x` is under node `y` (a node is not a descendant
+    of itself). Only the ancestors of `x` up to `y` are visited, so it costs
+    O(depth) no matter how big the subtree of `y` is."""
+    return are_descendants(Session, table, [(x, y)])[0]
+
+def _walk_both(Session, table, x, y):
+    return _chains(Session, table, [(x, y), (y, x)])
+
+def lowest_common_ancestor(Session, table, x, y):
+    """Return the id of the deepest node that is an ancestor of both `x` and
+    `y` (a node counts as its own ancestor), or None if they don't belong to
+    the same tree. Each node is walked up until it meets the other one or a
+    root, in a single round trip."""
+    up_x, up_y = _walk_both(Session, table, x, y)
+    seen = set(up_y)
+    for ev in up_x:
+        if ev in seen:
+            return ev
+    return None
+
+def path_between(Session, table, x, y):
+    """Return the list of ids going from `x` to `y` through their lowest
+    common ancestor (e.g. [x, parent of x, ..., y] if `y` is an ancestor of
+    `x`), or None if they don't belong to the same tree"""
+    up_x, up_y = _walk_both(Session, table, x, y)
+    seen = set(up_y)
+    for pos, ev in enumerate(up_x):
+        if ev in seen:
+            down = up_y[:up_y.index(ev)]
+            down.reverse()
+            return up_x[:pos + 1] + down
+    return None
@@ -0,0 +1,127 @@
+# -*- coding: UTF-8 -*-
+"""Execute several Hierarchy queries in a single round trip"""
+
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import Executable, ClauseElement
+from sqlalchemy.types import NullType
+from sqlalchemy.util import NamedTuple
+
+from hierarchy import _check_dialect
+
+__all__ = ['HierarchyBatch', 'execute_batch']
+
+class HierarchyBatch(Executable, ClauseElement):
+    """Wrap a list of Hierarchy objects in a single statement.
+    Every Hierarchy becomes one branch of a 'union all': the branch
+    returns the number of the Hierarchy it belongs to (hierarchy_index)
+    and fills its own block of columns, leaving the blocks of the other
+    Hierarchy objects as null. Since every Hierarchy is compiled by the same
+    compiler, their bind parameters don't clash. With pgsql, columns of the
+    select whose type is unknown (e.g. a literal_column without type_) are
+    padded with untyped nulls, so give them a type if you batch more than
+    two hierarchies.
+    Use execute_batch to run it and split the rows back."""
+    def __init__(self, hierarchies):
+        self.hierarchies = list(hierarchies)
+        # names of the columns returned by every hierarchy
+        self.names = [[ev.name for ev in h.columns] \
+                      for h in self.hierarchies]
+        self.types = [[ev.type for ev in h.columns] \
+                      for h in self.hierarchies]
+
+    def _block(self, pos):
+        return ["c%d_%d" % (pos, ev) for ev in range(len(self.names[pos]))]
+
+def _ordering_path(h):
+    """Name of the ordering path column of a Hierarchy (None if absent)"""
+    if h.path_encoding == 'binary':
+        return 'sort_path'
+    name = '%s_path' % (h.ordering_colname)
+    if h.ordering_colname and name in [ev.name for ev in h.columns]:
+        return name
+    return None
+
+def _branches(element, compiler, extra, column=lambda h, name: "h.%s" % name,
+              null=lambda type_: "null", **kw):
+    branches = []
+    for pos, h in enumerate(element.hierarchies):
+        cols = ["%d as hierarchy_index" % (pos)] + extra(pos)
+        for other in range(len(element.hierarchies)):
+            if other == pos:
+                cols.extend(["%s as %s" % (column(h, name), alias) \
+                             for name, alias in \
+                             zip(element.names[pos], element._block(pos))])
+            else:
+                cols.extend(["%s as %s" % (null(type_), alias) \
+                             for type_, alias in \
+                             zip(element.types[other],
+                                 element._block(other))])
+        branches.append("select %s from %s h" % (
+            ", ".join(cols), compiler.process(h, asfrom=True, **kw)))
+    return branches
+
+@compiles(HierarchyBatch)
+def visit_hierarchy_batch(element, compiler, **kw):
+    """If the database bound to the connection is not supported, a
+    NotImplementedError will be raised"""
+    _check_dialect(compiler.dialect)
+
+@compiles(HierarchyBatch, 'postgresql')
+def visit_hierarchy_batch(element, compiler, **kw):
+    """visit compilation idiom for pgsql: each Hierarchy keeps its own order
+    since we sort by hierarchy_index and then by the path column of every
+    block (null for the rows of the other blocks). Nulls are cast to the
+    type of their column: pgsql resolves the union two branches at a time,
+    so two untyped nulls would become text and clash with the next
+    branch"""
+    _check_dialect(compiler.dialect)
+    def null(type_):
+        if type_._type_affinity is NullType:
+            return "null"
+        return "cast(null as %s)" % (
+            compiler.dialect.type_compiler.process(type_))
+    order = ["hierarchy_index"]
+    for pos, names in enumerate(element.names):
+        path = _ordering_path(element.hierarchies[pos]) or 'connect_path'
+        order.append(element._block(pos)[names.index(path)])
+    return "%s\norder by %s" % (
+        "\nunion all\n".join(_branches(element, compiler, lambda pos: [],
+                                       null=null, **kw)),
+        ", ".join(order))
+
+@compiles(HierarchyBatch, 'oracle')
+def visit_hierarchy_batch(element, compiler, **kw):
+    """visit compilation idiom for oracle: connect by doesn't sort its
+    output, so we keep the order in which every Hierarchy returns its rows
+    with rownum. Columns of the inner queries are quoted since some of them
+    (level) are oracle keywords, and the ordering (or sort) path, not built
+    for oracle, is returned as null"""
+    _check_dialect(compiler.dialect)
+    def column(h, name):
+        if name == _ordering_path(h):
+            return "null"
+        return 'h."%s"' % (name.upper())
+    return "%s\norder by hierarchy_index, hierarchy_row" % (
+        "\nunion all\n".join(_branches(
+            element, compiler, lambda pos: ["rownum as hierarchy_row"],
+            column=column, **kw)))
+
+def execute_batch(Session, hierarchies):
+    """Execute every Hierarchy in `hierarchies` in a single round trip. It
+    returns a list with the rows of every Hierarchy, in the same order they
+    were given. Rows are tuples with the same labels (e.g. row.level) the
+    Hierarchy itself would return."""
+    batch = HierarchyBatch(hierarchies)
+    results = [[] for ev in batch.hierarchies]
+    offsets = []
+    start = 1
+    for names in batch.names:
+        offsets.append(start)
+        start += len(names)
+    for row in Session.execute(batch):
+        pos = row[0]
+        # oracle has an extra hierarchy_row column
+        first = offsets[pos] + len(row) - start
+        results[pos].append(NamedTuple(
+            row[first:first + len(batch.names[pos])], batch.names[pos]))
+    return results
@@ -0,0 +1,165 @@
+# -*- coding: UTF-8 -*-
+"""Export the result of a Hierarchy to columnar (numpy/arrow) arrays"""
+
+from sqlalchemy import Integer
+
+from hierarchy import _where_mode
+
+__all__ = ['HierarchyArrays', 'hierarchy_arrays']
+
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise(ImportError("numpy is required to export a Hierarchy to "
+                          "arrays"))
+    return numpy
+
+def _path_ids(connect_path):
+    """connect_path as a list of unicode ids (oracle returns it as a comma
+    separated string)"""
+    if isinstance(connect_path, basestring):
+        return connect_path.split(',')
+    return [unicode(ev) for ev in connect_path]
+
+class _ColumnBuffer(object):
+    """Growable numpy buffer: we don't know how many rows the hierarchy
+    has until we fetch the last batch, so capacity is doubled as needed"""
+    def __init__(self, numpy, dtype, capacity):
+        self.numpy = numpy
+        self.data = numpy.empty(capacity, dtype=dtype)
+        self.size = 0
+
+    def extend(self, values):
+        needed = self.size + len(values)
+        if needed > len(self.data):
+            capacity = len(self.data)
+            while capacity < needed:
+                capacity *= 2
+            data = self.numpy.empty(capacity, dtype=self.data.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+        self.data[self.size:needed] = values
+        self.size = needed
+
+    def array(self):
+        if self.size == len(self.data):
+            return self.data
+        return self.data[:self.size].copy()
+
+class HierarchyArrays(object):
+    """Columnar version of a Hierarchy resultset. Every attribute is a numpy
+    array with one element per row, in the same (preorder) order the
+    Hierarchy returned them:
+        * id: the value of the referenced column (the `child` of the self
+              referential foreign key)
+        * parent: position (not id) of the parent row in these same arrays,
+                  -1 for the root nodes
+        * level: same as the level column in Hierarchy
+        * is_leaf: same as the is_leaf column in Hierarchy
+        * preorder: position of the row in a depth first traversal
+    """
+    names = ('id', 'parent', 'level', 'is_leaf', 'preorder')
+
+    def __init__(self, id, parent, level, is_leaf, preorder):
+        self.id = id
+        self.parent = parent
+        self.level = level
+        self.is_leaf = is_leaf
+        self.preorder = preorder
+
+    def __len__(self):
+        return len(self.id)
+
+    def to_arrow(self):
+        """Return the arrays as a pyarrow.Table (pyarrow is required)"""
+        try:
+            import pyarrow
+        except ImportError:
+            raise(ImportError("pyarrow is required to build an arrow table"))
+        return pyarrow.Table.from_arrays(
+            [pyarrow.array(getattr(self, ev)) for ev in self.names],
+            names=list(self.names))
+
+def hierarchy_arrays(Session, hierarchy, batch_size=10000, id_dtype=None):
+    """Execute `hierarchy` and load its rows into a HierarchyArrays object
+    without building a python object per node.
+    Rows are fetched `batch_size` at a time from a server side cursor (when
+    the driver supports it), so memory is bounded by the arrays themselves
+    plus one batch. Since the Hierarchy resultset is ordered depth first, the
+    parent of every row is the last row seen one level above it, so we only
+    need to keep a stack as deep as the tree to compute the parent
+    positions. The stack is checked against connect_path: siblings sharing
+    an ordering value may have their subtrees mixed, which raises
+    ValueError (path_encoding='binary' breaks the ties by id). With
+    where_mode='filter' such a row can't be told from one whose parent was
+    filtered out, so it gets -1.
+    With where_mode='filter' the parent of a row may have been filtered out:
+    `parent` points to the parent row only if it was returned, -1
+    otherwise.
+    `id_dtype` defaults to int64 for integer ids and object otherwise.
+    The select used to build the hierarchy must include the referenced id
+    column."""
+    numpy = _import_numpy()
+    if hierarchy.child not in hierarchy.select.c:
+        raise(ValueError("The select must include the '%s' column to export "
+                         "the hierarchy" % (hierarchy.child)))
+    if id_dtype is None:
+        id_type = hierarchy.select.c[hierarchy.child].type._type_affinity
+        id_dtype = numpy.int64 if id_type is Integer else object
+    capacity = max(batch_size, 1)
+    ids = _ColumnBuffer(numpy, id_dtype, capacity)
+    parents = _ColumnBuffer(numpy, numpy.int64, capacity)
+    levels = _ColumnBuffer(numpy, numpy.int32, capacity)
+    leaves = _ColumnBuffer(numpy, numpy.bool_, capacity)
+    # stack[n] is the position of the last row seen at level n + 1 and
+    # stack_ids[n] its id, to check it against connect_path
+    stack, stack_ids = [], []
+    conn = Session.connection().execution_options(stream_results=True)
+    filtered = _where_mode(hierarchy, conn.dialect.name) == 'filter'
+    rs = conn.execute(hierarchy)
+    position = 0
+    while True:
+        rows = rs.fetchmany(batch_size)
+        if not rows:
+            break
+        b_ids, b_parents, b_levels, b_leaves = [], [], [], []
+        for row in rows:
+            level = row.level
+            node = getattr(row, hierarchy.child)
+            del stack[level - 1:]
+            del stack_ids[level - 1:]
+            path = _path_ids(row.connect_path)
+            # drop the rows of other branches left in the stack by the rows
+            # filtered out between them and this one
+            while stack_ids and \
+                  unicode(stack_ids[-1]) != path[len(stack_ids) - 1]:
+                stack.pop()
+                stack_ids.pop()
+            if len(stack) == level - 1:
+                parent = stack[-1] if stack else -1
+            elif filtered:
+                parent = -1
+                while len(stack) < level - 1:
+                    stack.append(-1)
+                    stack_ids.append(None)
+            else:
+                raise(ValueError("The rows are not in depth first order (%s "
+                                 "comes after another subtree): "
+                                 "siblings must not share an ordering "
+                                 "value" % (node)))
+            stack_ids.append(node)
+            b_ids.append(node)
+            b_parents.append(parent)
+            b_levels.append(level)
+            b_leaves.append(bool(row.is_leaf))
+            stack.append(position)
+            position += 1
+        ids.extend(b_ids)
+        parents.extend(b_parents)
+        levels.extend(b_levels)
+        leaves.extend(b_leaves)
+    rs.close()
+    return HierarchyArrays(ids.array(), parents.array(), levels.array(),
+                           leaves.array(),
+                           numpy.arange(position, dtype=numpy.int64))
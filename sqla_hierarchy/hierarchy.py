@@ -1,22 +1,35 @@
 # -*- coding: UTF-8 -*-
 """Queries to generate hierarchical relations"""
 
-from sqlalchemy import Integer, and_, String, Boolean
+from sqlalchemy import Integer, and_, String, Boolean, LargeBinary
 from sqlalchemy.sql import select
 from sqlalchemy.sql.expression import func, literal_column, label, literal
+from sqlalchemy.sql.expression import case, cast
 from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.dialects.postgresql.base import ARRAY
 from sqlalchemy.sql.expression import (
-    Select, TableClause, ColumnClause
+    Select, TableClause, ColumnClause, FromClause
 )
+from sqlalchemy.sql.util import ClauseAdapter
 __all__ = ['Hierarchy', 'supported_db', 'HierarchyLesserError',
-           'MissingForeignKeyError']
+           'MissingForeignKeyError', 'HierarchyCycleError', 'where_modes',
+           'path_encodings']
 
 supported_db = {
     'postgresql': (8,4,0),
     'oracle': (10,0,0)
     }
 
+# minimum versions needed for the max_children option
+max_children_db = {
+    'postgresql': (9,3,0),
+    'oracle': (10,0,0)
+    }
+
+where_modes = ('prune', 'anchor', 'filter')
+
+path_encodings = ('array', 'binary')
+
 class HierarchyError(Exception):
     """Base error class for Hierarchy"""
     pass
@@ -42,14 +55,69 @@ class HierarchyLesserError(HierarchyError):
                                        ".".join([str(x) for x in \
                                                  self.version]))
 
+class HierarchyCycleError(HierarchyError):
+    """If an operation would make a node its own ancestor (e.g. moving a
+    subtree below one of its own descendants), this error will be raised"""
+    def __init__(self, relation, node, new_parent):
+        self.relation = relation
+        self.node = node
+        self.new_parent = new_parent
+        self.args = ("Moving %s below %s would create a cycle in relation "\
+                     "%s" % (self.node, self.new_parent, self.relation), )
+
+def _find_self_reference(table):
+    """Look for the foreign key in `table` that refers to the same table.
+    It returns a (parent, child) tuple with the names of the referencing
+    column and the referenced column, or raises MissingForeignKeyError if the
+    table doesn't have such a relation"""
+    for ev in table.foreign_keys:
+        if ev.column.table.name==ev.parent.table.name:
+            return ev.parent.name, ev.column.name
+    raise(MissingForeignKeyError(table.name))
+
+def _check_dialect(dialect):
+    """Raise NotImplementedError or HierarchyLesserError if the dialect (or
+    the version of the server behind it) is not in supported_db"""
+    if dialect.name not in supported_db:
+        raise(NotImplementedError("This method hasn't been written "
+                                  "for %s dialect yet" % (dialect.name)))
+    if dialect.server_version_info < supported_db[dialect.name]:
+        raise(HierarchyLesserError(dialect.name, supported_db[dialect.name]))
+
+def _where_mode(hierarchy, dialect_name):
+    """The where_mode `hierarchy` uses with the `dialect_name` dialect: the
+    one it was given or, by default, 'filter' for oracle when the select has
+    a where clause (oracle always applied it after the connect by) and
+    'prune' otherwise (without a where clause every mode returns the same
+    rows)"""
+    if hierarchy.where_mode is not None:
+        return hierarchy.where_mode
+    if dialect_name == 'oracle' and hierarchy.select._whereclause is not None:
+        return 'filter'
+    return 'prune'
+
+def _sorts_like_pgsql(hierarchy):
+    """True if sorting the paths of `hierarchy` in python gives the order
+    pgsql gives them: the ids are integers and so is the ordering column,
+    not nullable, if the select has it (text collations and nulls sort
+    differently)"""
+    ordering = hierarchy.select.c.get(hierarchy.ordering_colname)
+    if hierarchy.table.c[hierarchy.child].type._type_affinity \
+       is not Integer:
+        return False
+    return ordering is None or (not getattr(ordering, 'nullable', True) and \
+                                ordering.type._type_affinity is Integer)
+
 def _build_table_clause(select, name, path_type, ordering_colname=None,
-                        ordering_coltype=Integer):
+                        ordering_coltype=Integer, sort_path=False):
     """For pgsql, it builds the recursive table needed to perform a
     hierarchical query.
     Parameters:
         * select instruction of type sqlalchemy.sql.expression.Select
         * a name for the new virtual table
         * the type for the connect_path column
+        * the name and type of the ordering column (if any)
+        * whether to add the sort_path column (binary path encoding)
     It returns a TableClause object
     """
     cols = []
@@ -60,9 +128,103 @@ def _build_table_clause(select, name, path_type, ordering_colname=None,
     if ordering_colname:
         cols.append(ColumnClause('%s_path' % ordering_colname,
                                 type_=ARRAY(ordering_coltype)))
+    if sort_path:
+        cols.append(ColumnClause('sort_path', type_=LargeBinary))
     tb = TableClause(name, *cols)
     return tb
 
+class _LateralChildren(FromClause):
+    """For pgsql, a lateral subquery returning up to `limit` children of the
+    current 'rec' row, ordered by `ordering`. It's named after the table it
+    replaces in the recursive term (and hides that table from the FROM list)
+    so every reference to the table points to it instead."""
+    def __init__(self, table, parent, child, ordering, limit,
+                 whereclause=None):
+        self.table = table
+        self.parent = parent
+        self.child = child
+        self.ordering = ordering
+        self.limit = limit
+        self.whereclause = whereclause
+
+    @property
+    def _hide_froms(self):
+        return [self.table]
+
+@compiles(_LateralChildren)
+def visit_lateral_children(element, compiler, **kw):
+    # rec is referenced as a literal so the subquery doesn't add it to its
+    # own FROM list (pgsql doesn't allow the recursive reference in there)
+    where = getattr(element.table.c, element.parent)==\
+            literal_column("rec.%s" % (element.child))
+    if element.whereclause is not None:
+        where = and_(where, element.whereclause)
+    sel = select([element.table], where).\
+            order_by(*_children_sort(element.table, element.ordering,
+                                     element.child)).\
+            limit(element.limit)
+    return "lateral %s as %s" % (
+        compiler.process(sel, asfrom=True),
+        compiler.preparer.format_table(element.table, use_schema=False))
+
+def _ranked_children(table, parent, child, ordering, whereclause=None):
+    """For oracle, an inline view (named as `table`) with the rows of `table`
+    matching `whereclause` plus the position of each row among its siblings
+    (hierarchy_rn)"""
+    return select([table, func.row_number().over(
+        partition_by=getattr(table.c, parent),
+        order_by=_children_sort(table, ordering, child)).\
+        label('hierarchy_rn')], whereclause).alias(table.name)
+
+def _children_sort(table, ordering, child):
+    """Sort keys for the siblings: the id breaks ties in `ordering`, so the
+    same children are picked on every run"""
+    keys = [getattr(table.c, ordering)]
+    if ordering != child:
+        keys.append(getattr(table.c, child))
+    return keys
+
+def _children_ordering(element):
+    """Column used to choose the first children of every node when
+    max_children is set"""
+    if element.ordering_colname and \
+       element.ordering_colname in element.table.c:
+        return element.ordering_colname
+    return element.child
+
+def _visit_nested_sets(element, compiler, **kw):
+    """For pgsql, the rows below the starting node are the ones whose
+    interval is inside its interval (a range scan over lft), already sorted
+    by lft. connect_path (and the ordering path) are sliced from the paths
+    stored in the side table, dropping the part above the starting node"""
+    side = element.nested_sets
+    ns = side.alias('hierarchy_ns')
+    if element.starting_node is False or \
+       (element.fk_type is not None and element.starting_node in ("0", "a")):
+        # every root: an interval containing the whole table
+        root = select([literal_column('0', type_=Integer).label('lft'),
+                       (func.max(side.c.rgt) + 1).label('rgt'),
+                       literal_column('0', type_=Integer).label('level')])
+    else:
+        root = select([side.c.lft, side.c.rgt, side.c.level],
+                      getattr(side.c, element.child)==\
+                      literal(element.starting_node, type_=String))
+    root = root.alias('hierarchy_root')
+    sel = element.select._clone().where(and_(
+        getattr(ns.c, element.child)==getattr(element.table.c, element.child),
+        ns.c.lft > root.c.lft, ns.c.rgt < root.c.rgt))
+    path = "(hierarchy_ns.%s)[hierarchy_root.level + 1:hierarchy_ns.level]"
+    sel.append_column((ns.c.level - root.c.level).label('level'))
+    sel.append_column(literal_column(path % ('connect_path'),
+        type_=ARRAY(element.path_type)).label('connect_path'))
+    ordering_path = '%s_path' % (element.ordering_colname)
+    if ordering_path in [ev.name for ev in element.columns]:
+        sel.append_column(literal_column(path % (ordering_path),
+            type_=ARRAY(element.select.c[element.ordering_colname].type)).\
+            label(ordering_path))
+    sel.append_column((ns.c.rgt==ns.c.lft + 1).label('is_leaf'))
+    return compiler.process(sel.order_by(ns.c.lft), **kw)
+
 class Hierarchy(Select):
     """Given a sqlalchemy.schema.Table and a sqlalchemy.sql.expression.Select,
     this class will return the information from these objects with some extra
@@ -99,6 +261,49 @@ class Hierarchy(Select):
           in the query. By default the system will add a 'starting_node'="0". If
           you don't want a starting node, pass 'starting_node'=False and the
           clause will not be added to the query
+        * The where clause of the select can be applied in three different
+          ways, chosen with the 'where_mode' parameter in the **kwargs:
+            - 'prune' (default on pgsql): the clause is checked for the
+              starting nodes and on every recursion step, so a node that
+              doesn't match is discarded together with its whole subtree.
+              This is the cheapest option since pruned branches are never
+              visited.
+            - 'anchor': the clause is only checked for the starting nodes,
+              their descendants are returned no matter what.
+            - 'filter' (default on oracle, which always applied a plain
+              where clause after the connect by): the full hierarchy is
+              traversed and the clause is only used to filter the returned
+              rows. level, connect_path and is_leaf keep describing the full
+              tree.
+        * To keep huge fan-outs from exploding the traversal, pass the
+          'max_children' parameter in the **kwargs: only the first
+          max_children children of every node (ordered by the
+          ordering_colname column if the table has it, then by id) are
+          visited. The starting nodes are not limited. pgsql uses a lateral
+          subquery with a limit in the recursive step, so only those
+          children are ever read (pgsql >= 9.3 is needed, otherwise
+          HierarchyLesserError is raised). Oracle ranks the siblings before
+          the connect by. is_leaf is computed over the returned rows.
+        * Rows are sorted by their path from the root. By default (the
+          'path_encoding' parameter in the **kwargs set to 'array') pgsql
+          builds that path as an array of the ordering column (or of ids)
+          which is slow to sort for wide keys (varchar, uuid). With
+          path_encoding='binary' the ordering column isn't copied into an
+          array: every node gets its rank among its siblings and the path is
+          a bytea of 4 bytes per level (returned as sort_path instead of the
+          ordering path), which sorts with a plain memcmp no matter the type
+          of the ids or the ordering column. Oracle ignores this parameter
+          since connect by already returns the rows in hierarchical order.
+        * If the tree was numbered with build_nested_sets, pass the side
+          table it was written to as the 'nested_sets' parameter in the
+          **kwargs: pgsql answers the subtree of the starting node with a
+          range scan over the lft/rgt intervals instead of recursing (the
+          numbers must be rebuilt when the tree changes). connect_path and
+          the ordering path are sliced from the ones stored in the side
+          table. The where
+          clause can only filter the rows (where_mode='filter') and
+          max_children and path_encoding can't be used, otherwise
+          ValueError is raised. Oracle doesn't support it.
     For examples of Hierarchy, check the tests dir.
     """
     def __init__(self, Session, table, select, **kw):
@@ -110,15 +315,45 @@ class Hierarchy(Select):
         self._whereclause = select._whereclause
         self.fk_type = None
         # we need to find the relation within the same table
-        for ev in self.table.foreign_keys:
-            if ev.column.table.name==ev.parent.table.name:
-                self.parent = ev.parent.name
-                self.child = ev.column.name
-                break
-        if self.parent is None or self.child is None:
-            raise(MissingForeignKeyError(self.table.name))
+        self.parent, self.child = _find_self_reference(self.table)
         self.starting_node = kw.pop('starting_node', None)
         self.ordering_colname = kw.pop('ordering_colname', 'ordering')
+        # None: chosen for the dialect the query is compiled for (see
+        # _where_mode)
+        self.where_mode = kw.pop('where_mode', None)
+        self.max_children = kw.pop('max_children', None)
+        if self.max_children is not None and \
+           (not isinstance(self.max_children, (int, long)) or \
+            self.max_children < 1):
+            raise(ValueError("max_children must be a positive integer"))
+        self.path_encoding = kw.pop('path_encoding', 'array')
+        # extra condition only checked for the starting nodes (see
+        # HierarchyCache.refresh)
+        self._start_with = None
+        if self.where_mode is not None and \
+           self.where_mode not in where_modes:
+            raise(ValueError("where_mode must be one of %s" % \
+                             (", ".join(where_modes))))
+        if self.path_encoding not in path_encodings:
+            raise(ValueError("path_encoding must be one of %s" % \
+                             (", ".join(path_encodings))))
+        self.nested_sets = kw.pop('nested_sets', None)
+        if self.nested_sets is not None:
+            if self.max_children or self.path_encoding != 'array':
+                raise(ValueError("nested_sets can't be used with "
+                                 "max_children or path_encoding"))
+            if select._whereclause is not None and \
+               self.where_mode != 'filter':
+                raise(ValueError("With nested_sets the where clause can "
+                                 "only filter the rows (where_mode="
+                                 "'filter')"))
+            if self.ordering_colname in select.columns and \
+               '%s_path' % (self.ordering_colname) not in \
+               self.nested_sets.c:
+                raise(ValueError("The nested_sets table has no %s_path "
+                                 "column" % (self.ordering_colname)))
+        # type of the ids building connect_path
+        self.path_type = self.table.c[self.child].type
         # if starting node does not exist or it's null, we add starting_node=0
         # by default
         if not hasattr(self, 'starting_node') or self.starting_node is None:
@@ -128,7 +363,6 @@ class Hierarchy(Select):
             # identify this situation and use "a" for comparison
             if self.fk_type == String:
                 setattr(self, 'starting_node', "a")
-                self.type_length = self.table.columns.get(self.parent).type.length
             else:
                 setattr(self, 'starting_node', "0")
         elif not self.starting_node:
@@ -139,10 +373,12 @@ class Hierarchy(Select):
             self.starting_node = str(self.starting_node)
         columns = select.columns + [
             ColumnClause('level', type_=Integer()),
-            ColumnClause('connect_path', type_=ARRAY(self.fk_type)),
+            ColumnClause('connect_path', type_=ARRAY(self.path_type)),
             ColumnClause('is_leaf', type_=Boolean())
         ]
-        if self.ordering_colname in select.columns:
+        if self.path_encoding == 'binary':
+            columns.append(ColumnClause('sort_path', type_=LargeBinary()))
+        elif self.ordering_colname in select.columns:
             columns.append(ColumnClause('%s_path' % self.ordering_colname,
                                         type_=ARRAY(select.c[self.ordering_colname].type)))
         Select.__init__(self, columns, **kw)
@@ -161,8 +397,29 @@ def visit_hierarchy(element, compiler, **kw):
     if compiler.dialect.server_version_info < supported_db['oracle']:
         raise(HierarchyLesserError(compiler.dialect.name, 
                                    supported_db['oracle']))
+    elif element.nested_sets is not None:
+        raise(NotImplementedError("nested_sets hasn't been written for "
+                                  "oracle yet"))
     else:
-        sel = element.select
+        where_mode = _where_mode(element, compiler.dialect.name)
+        sel = element.select._clone()
+        where = None
+        if element.max_children:
+            # siblings are ranked in an inline view replacing the table, so
+            # connect by can skip the ones after max_children. In prune mode
+            # the where clause goes in there too so only matching siblings
+            # are ranked
+            sel = ClauseAdapter(_ranked_children(
+                element.table, element.parent, element.child,
+                _children_ordering(element), sel._whereclause if where_mode == 'prune' \
+                else None)).traverse(
+                    sel.with_only_columns(list(sel.inner_columns)))
+        # unless the user wants to filter the output, the where clause is
+        # moved from the select (which oracle applies after building the
+        # hierarchy) to the start with and connect by clauses
+        if where_mode != 'filter' and sel._whereclause is not None:
+            where = compiler.process(sel._whereclause)
+            sel._whereclause = None
         sel.append_column(literal_column('level', type_=Integer))
         sel.append_column(literal_column('CONNECT_BY_ISLEAF', 
                                          type_=Boolean).label('is_leaf'))
@@ -170,17 +427,29 @@ def visit_hierarchy(element, compiler, **kw):
             "LTRIM(SYS_CONNECT_BY_PATH (%s,','),',')" % (element.child),
             type_=String).label('connect_path'))
         qry = "%s"  % (compiler.process(sel))
+        start = []
+        connect = ["prior %s=%s" % (element.child, element.parent)]
         if hasattr(element, 'starting_node') and \
            getattr(element, 'starting_node') is not False:
             if (element.starting_node == "a" and element.fk_type==String) or\
                (element.starting_node == "0" and element.fk_type==Integer):
-                qry += " start with %s is null" % (element.parent)
+                start.append("%s is null" % (element.parent))
             elif getattr(element, 'starting_node') is False:
                 pass
             else:
-                qry += " start with %s=%s" % (element.parent,
-                                             element.starting_node)
-        qry += " connect by prior %s=%s" % (element.child, element.parent)
+                start.append("%s=%s" % (element.parent,
+                                        element.starting_node))
+        if element._start_with is not None:
+            start.append("(%s)" % (compiler.process(element._start_with)))
+        if where is not None:
+            start.append("(%s)" % (where))
+            if where_mode == 'prune':
+                connect.append("(%s)" % (where))
+        if element.max_children:
+            connect.append("hierarchy_rn<=%d" % (int(element.max_children)))
+        if start:
+            qry += " start with %s" % (" and ".join(start))
+        qry += " connect by %s" % (" and ".join(connect))
         if kw.get('asfrom', False):
             qry = '(%s)' % qry
         return qry
@@ -198,23 +467,40 @@ def visit_hierarchy(element, compiler, **kw):
     if compiler.dialect.server_version_info < supported_db['postgresql']:
         raise(HierarchyLesserError(compiler.dialect.name,
                                    supported_db['postgresql']))
+    elif element.nested_sets is not None:
+        return _visit_nested_sets(element, compiler, **kw)
     else:
+        where_mode = _where_mode(element, compiler.dialect.name)
         if element.fk_type == String:
-            element.fk_type = String(element.type_length)
             val = "a"
         else:
-            element.fk_type = Integer
             val = "0"
         ordering_colname = element.ordering_colname
         if not ordering_colname or ordering_colname not in element.table.c\
                 and ordering_colname not in element.select.c:
             ordering_colname = None
-        # FIXME: pass type of ordering column in following call if it's not 
-        # Integer
+        is_binary = element.path_encoding == 'binary'
+        # with the binary encoding the ordering column only matters to rank
+        # the siblings, we don't build its path
         is_ordering = ordering_colname and ordering_colname in \
-                element.select.columns
+                element.select.columns and not is_binary
+        ordering_coltype = Integer
+        if is_ordering:
+            ordering_coltype = element.select.c[ordering_colname].type
         rec = _build_table_clause(element.select, 'rec', 
-                element.fk_type, ordering_colname if is_ordering else None)
+                element.path_type, ordering_colname if is_ordering else None,
+                ordering_coltype, is_binary)
+        # for the binary encoding, the position of every row among its
+        # siblings (4 bytes, big endian, so it sorts with memcmp). The
+        # starting nodes are ranked all together: without a starting node
+        # they don't share a parent and would get the same sort_path
+        rank_order = [getattr(element.table.c, _children_ordering(element)),
+                      getattr(element.table.c, element.child)]
+        rank = func.int4send(cast(func.row_number().over(
+            partition_by=getattr(element.table.c, element.parent),
+            order_by=rank_order), Integer))
+        start_rank = func.int4send(cast(func.row_number().over(
+            order_by=rank_order), Integer))
         # documentation used for pgsql >= 8.4.0
         #
         # * http://www.postgresql.org/docs/8.4/static/queries-with.html
@@ -224,6 +510,16 @@ def visit_hierarchy(element, compiler, **kw):
         # build the first select
         sel1 = element.select._clone()
         sel1._copy_internals()
+        # when filtering the output, the where clause is not used to build
+        # the tree but evaluated once per row as the hierarchy_keep column
+        # (see below)
+        keep = None
+        if where_mode == 'filter' and \
+           element.select._whereclause is not None:
+            sel1._whereclause = None
+            keep = case([(element.select._whereclause,
+                          literal_column("true", type_=Boolean))],
+                        else_=literal_column("false", type_=Boolean))
         # if the user wants to start from a given node, he pass the
         # starting_node option in the query
         if hasattr(element, 'starting_node') and \
@@ -232,11 +528,13 @@ def visit_hierarchy(element, compiler, **kw):
                 literal_column(element.parent, type_=String),
                 literal(val, type_=String))==\
                 literal(element.starting_node, type_=String))
+        if element._start_with is not None:
+            sel1 = sel1.where(element._start_with)
         # the same select submitted by the user plus a 1 as the first level and
         # an array with the current id
         sel1.append_column(literal_column('1', type_=Integer).label('level'))
         sel1.append_column(literal_column('ARRAY[%s]' %(element.child), 
-                                          type_=ARRAY(element.fk_type)).\
+                                          type_=ARRAY(element.path_type)).\
                            label('connect_path'))
         if is_ordering:
             ordering_col = sel1.c.get(ordering_colname, None)
@@ -246,16 +544,24 @@ def visit_hierarchy(element, compiler, **kw):
                                               type_=ARRAY(ordering_col.type)).\
                                label('%s_path' % (ordering_colname,))
             )
+        if is_binary:
+            sel1.append_column(start_rank.label('sort_path'))
         # the non recursive part of the with query must return false for the
         # first values
         sel1.append_column(literal_column("false", type_=Boolean).\
                            label('cycle'))
+        if keep is not None:
+            sel1.append_column(keep.label('hierarchy_keep'))
         # build the second select
         # the same select as above plus the level column is summing a 1 for
         # each iteration on the same brach. We also append the current id to
         # the array of ids we're building as connect_path
         sel2 = element.select._clone()
         sel2._copy_internals()
+        # only the 'prune' mode checks the where clause on every recursion
+        # step
+        if where_mode != 'prune':
+            sel2._whereclause = None
         sel2.append_column(label('level', 
                                  rec.c.level+literal_column("1",
                                                             type_=Integer)))
@@ -269,12 +575,29 @@ def visit_hierarchy(element, compiler, **kw):
                                         getattr(element.table.c, 
                                             ordering_colname))
                                 ))
+        if is_binary:
+            sel2.append_column(label('sort_path',
+                                     rec.c.sort_path.op('||')(rank)))
         # check if any member of connect_path has already been visited and
         # return true in that case, preventing an infinite loop (see where
         # section
         sel2.append_column(literal_column(
                 "%s=ANY(connect_path)" % getattr(element.table.c, 
                                                  element.child)).label('cycle'))
+        if keep is not None:
+            sel2.append_column(keep.label('hierarchy_keep'))
+        if element.max_children:
+            if compiler.dialect.server_version_info < \
+               max_children_db['postgresql']:
+                raise(HierarchyLesserError(compiler.dialect.name,
+                                           max_children_db['postgresql']))
+            # the children of every node are read from a lateral subquery
+            # with a limit, so big fan-outs are never materialized
+            sel2 = sel2.select_from(_LateralChildren(
+                element.table, element.parent, element.child,
+                _children_ordering(element), element.max_children,
+                element.select._whereclause \
+                if where_mode == 'prune' else None))
         sel2 = sel2.where(and_(
             getattr(element.table.c,element.parent)==getattr(rec.c,
                                                              element.child),
@@ -289,15 +612,35 @@ def visit_hierarchy(element, compiler, **kw):
         # contained by the next row connect_path (we use the lead windowing
         # function for that). If it's contained it means the current id is not
         # a leaf, otherwise it is. 
-        new_sel.append_column(
-            literal_column("case connect_path <@ lead(connect_path, 1) over "\
-                           "(order by connect_path) when true then false "\
-                           "else true end").label('is_leaf')
-        )
+        if is_binary:
+            # same idea with the binary path: the next row is a child if the
+            # current sort_path is a prefix of it
+            new_sel.append_column(
+                literal_column("case substring(lead(sort_path, 1) over "\
+                               "(order by sort_path) from 1 for "\
+                               "length(sort_path)) = sort_path when true "\
+                               "then false else true end").label('is_leaf')
+            )
+        else:
+            new_sel.append_column(
+                literal_column("case connect_path <@ lead(connect_path, 1) "\
+                               "over (order by connect_path) when true then "\
+                               "false else true end").label('is_leaf')
+            )
+        body = "%s" % (new_sel)
+        if keep is not None:
+            # is_leaf must be computed over the full tree before filtering,
+            # so the filter goes in an outer query
+            new_sel.append_column(literal_column('hierarchy_keep',
+                                                 type_=Boolean))
+            body = "select %s from (%s) as hierarchy_rows where "\
+                   "hierarchy_keep" % (", ".join(
+                       [ev.name for ev in rec.c] + ['is_leaf']), new_sel)
         qry = "with recursive rec as (%s)\n%s\norder by %s_path" %\
                 (compiler.process(sel3),
-                 new_sel,
-                 ordering_colname if is_ordering else 'connect'
+                 body,
+                 'sort' if is_binary else \
+                 (ordering_colname if is_ordering else 'connect')
                 )
         if kw.get('asfrom', False):
             qry = '(%s)' % qry
@@ -0,0 +1,244 @@
+# -*- coding: UTF-8 -*-
+"""Keep a cached copy of a Hierarchy up to date recomputing only the
+subtrees that changed"""
+
+from sqlalchemy import event, String
+from sqlalchemy.orm import object_mapper
+from sqlalchemy.orm.exc import UnmappedInstanceError
+from sqlalchemy.util import NamedTuple
+
+from hierarchy import (
+    Hierarchy, _check_dialect, _find_self_reference, _sorts_like_pgsql,
+    _where_mode
+)
+
+__all__ = ['HierarchyCache', 'HierarchyDelta', 'ChangeTracker']
+
+class HierarchyDelta(object):
+    """What changed in a HierarchyCache after a refresh:
+        * inserted: rows that weren't in the cache
+        * removed: ids that are not part of the hierarchy anymore
+        * updated: new version of cached rows that changed (moved to a new
+                   position, so a new level/connect_path, is_leaf flipped or
+                   any other column modified)
+    """
+    def __init__(self):
+        self.inserted = []
+        self.removed = []
+        self.updated = []
+
+    def __len__(self):
+        return len(self.inserted) + len(self.removed) + len(self.updated)
+
+    def __repr__(self):
+        return "HierarchyDelta<%d inserted, %d removed, %d updated>" % (
+            len(self.inserted), len(self.removed), len(self.updated))
+
+class HierarchyCache(object):
+    """A cached copy of the rows returned by a Hierarchy, indexed by id.
+    Call load() once and then refresh() with the ids of the nodes that were
+    inserted, modified (e.g. re-parented) or deleted: only the subtrees of
+    those nodes are queried again (two statements no matter how many
+    changes) and the cache is patched in place.
+    Only pgsql is supported, and only the default Hierarchy options
+    (where_mode 'prune', array path encoding, no max_children, a starting
+    node): with any other option the cached rows don't hold enough
+    information to patch them, so NotImplementedError is raised. The rows
+    are sorted in python, so the ids must be integers, and so must the
+    ordering column if the select has it (which can't be nullable either),
+    otherwise NotImplementedError is raised too.
+    The select used to build the hierarchy must include the referenced id
+    column."""
+    def __init__(self, hierarchy):
+        # only pgsql is supported
+        if _where_mode(hierarchy, 'postgresql') != 'prune' or \
+           hierarchy.max_children or \
+           hierarchy.path_encoding != 'array' or \
+           hierarchy.starting_node is False:
+            raise(NotImplementedError("HierarchyCache only supports "
+                                      "hierarchies built with the default "
+                                      "options"))
+        if not _sorts_like_pgsql(hierarchy):
+            raise(NotImplementedError("HierarchyCache needs integer ids and "
+                                      "a not null integer ordering column"))
+        if hierarchy.child not in hierarchy.select.c:
+            raise(ValueError("The select must include the '%s' column to "
+                             "cache the hierarchy" % (hierarchy.child)))
+        self.hierarchy = hierarchy
+        self.ordering_path = None
+        if '%s_path' % (hierarchy.ordering_colname) in \
+           [ev.name for ev in hierarchy.columns]:
+            self.ordering_path = '%s_path' % (hierarchy.ordering_colname)
+        self.labels = [ev.name for ev in hierarchy.columns]
+        # id -> row
+        self.rows = {}
+        # parent id (None for the roots) -> set of children ids
+        self.children = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _row(self, values):
+        return NamedTuple([values[ev] for ev in self.labels], self.labels)
+
+    def _parent_of(self, row):
+        if len(row.connect_path) > 1:
+            return row.connect_path[-2]
+        return None
+
+    def _add(self, row):
+        node = getattr(row, self.hierarchy.child)
+        self.rows[node] = row
+        self.children.setdefault(self._parent_of(row), set()).add(node)
+
+    def _discard(self, node):
+        row = self.rows.pop(node)
+        self.children.get(self._parent_of(row), set()).discard(node)
+
+    def _subtree(self, node):
+        """Ids of the cached subtree of `node` (itself included)"""
+        nodes, pending = [], [node]
+        while pending:
+            ev = pending.pop()
+            nodes.append(ev)
+            pending.extend(self.children.get(ev, ()))
+        return nodes
+
+    def _is_top(self, parent):
+        """True if a node with this parent is a starting node (the same
+        coalesce the pgsql query uses)"""
+        if parent is None:
+            parent = self.hierarchy.fk_type == String and "a" or "0"
+        return str(parent) == self.hierarchy.starting_node
+
+    def load(self, Session):
+        """(Re)build the cache executing the whole Hierarchy"""
+        _check_dialect(Session.connection().dialect)
+        if Session.connection().dialect.name != 'postgresql':
+            raise(NotImplementedError("HierarchyCache hasn't been written "
+                                      "for %s dialect yet" % \
+                                      (Session.connection().dialect.name)))
+        self.rows, self.children = {}, {}
+        # rows are built by column name: pgsql returns is_leaf after the
+        # ordering path, Hierarchy.columns (our labels) has it before
+        for row in Session.execute(self.hierarchy):
+            self._add(self._row(dict(zip(row.keys(), row))))
+        return self
+
+    def ordered_rows(self):
+        """The cached rows in the same order the Hierarchy returns them"""
+        key = self.ordering_path or 'connect_path'
+        return sorted(self.rows.values(), key=lambda row: getattr(row, key))
+
+    def refresh(self, Session, changed):
+        """Recompute the subtrees of the `changed` ids, patch the cache and
+        return a HierarchyDelta"""
+        h = self.hierarchy
+        child_col = getattr(h.table.c, h.child)
+        parent_col = getattr(h.table.c, h.parent)
+        delta = HierarchyDelta()
+        changed = set(changed)
+        if not changed:
+            return delta
+        # where every changed node is now (missing ones were deleted)
+        current = dict(Session.execute(h.table.select(
+            child_col.in_(changed)).with_only_columns(
+                [child_col, parent_col])).fetchall())
+        # everything below a changed node may have moved or vanished
+        old = set()
+        for ev in changed:
+            if ev in self.rows:
+                old.update(self._subtree(ev))
+        # we only recompute the changed nodes hanging from a node we can
+        # trust: a starting node or a cached node whose path doesn't include
+        # any changed node. The others are either below another changed
+        # node (and recomputed with it) or not reachable anymore
+        parents = {}
+        for ev, parent in current.items():
+            if self._is_top(parent):
+                parents[ev] = None
+            elif parent in self.rows and parent not in changed and \
+                 not changed.intersection(self.rows[parent].connect_path):
+                parents[ev] = self.rows[parent]
+        new_rows = {}
+        if parents:
+            # a single recursive query starting from every root at once: the
+            # first id of connect_path is the root a row comes from, so its
+            # level and paths are rebased below the cached parent of that
+            # root
+            qry = Hierarchy(Session, h.table, h.select, starting_node=False,
+                            ordering_colname=h.ordering_colname,
+                            where_mode=h.where_mode)
+            qry._start_with = child_col.in_(parents.keys())
+            for row in Session.execute(qry):
+                values = dict(zip(row.keys(), row))
+                parent = parents[values['connect_path'][0]]
+                if parent is not None:
+                    values['level'] += parent.level
+                    values['connect_path'] = parent.connect_path + \
+                            values['connect_path']
+                    if self.ordering_path:
+                        values[self.ordering_path] = \
+                                getattr(parent, self.ordering_path) + \
+                                values[self.ordering_path]
+                new_rows[values[h.child]] = self._row(values)
+        # old parents of the changed nodes may have become leaves
+        touched = set()
+        for ev in changed:
+            if ev in self.rows:
+                touched.add(self._parent_of(self.rows[ev]))
+        # patch the cache
+        for ev in (old | changed) - set(new_rows):
+            if ev in self.rows:
+                delta.removed.append(ev)
+                self._discard(ev)
+        for node, row in new_rows.items():
+            if node in self.rows:
+                if tuple(self.rows[node]) != tuple(row):
+                    delta.updated.append(row)
+                self._discard(node)
+            else:
+                delta.inserted.append(row)
+            self._add(row)
+        for parent in [v.connect_path[-1] for v in parents.values() \
+                       if v is not None] + list(touched):
+            if parent in self.rows and parent not in new_rows:
+                row = self.rows[parent]
+                is_leaf = not self.children.get(parent)
+                if row.is_leaf != is_leaf:
+                    values = dict((k, getattr(row, k)) for k in self.labels)
+                    values['is_leaf'] = is_leaf
+                    self._discard(parent)
+                    self._add(self._row(values))
+                    delta.updated.append(self.rows[parent])
+        return delta
+
+class ChangeTracker(object):
+    """Collect the ids of the rows of `table` inserted, modified or deleted
+    through the ORM (listening to the after_flush event of `session`, which
+    can be a Session, a sessionmaker or a scoped_session), ready to be
+    passed to HierarchyCache.refresh. The same ids could come from an audit
+    table or any other change log."""
+    def __init__(self, session, table):
+        self.table = table
+        self.child = _find_self_reference(table)[1]
+        self.changed = set()
+        event.listen(session, 'after_flush', self._after_flush)
+
+    def _after_flush(self, session, flush_context):
+        # in after_flush new/dirty/deleted still hold the flushed objects
+        for objs in (session.new, session.dirty, session.deleted):
+            for obj in objs:
+                try:
+                    mapper = object_mapper(obj)
+                except UnmappedInstanceError:
+                    continue
+                if mapper.local_table is not self.table:
+                    continue
+                self.changed.add(getattr(obj, mapper.get_property_by_column(
+                    self.table.c[self.child]).key))
+
+    def pop(self):
+        """Return the collected ids and start collecting again"""
+        changed, self.changed = self.changed, set()
+        return changed
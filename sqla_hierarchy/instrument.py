@@ -0,0 +1,137 @@
+# -*- coding: UTF-8 -*-
+"""Instrumentation for Hierarchy queries: timings, rows per level, explain
+plans and missing index warnings"""
+
+import time
+import warnings
+
+from sqlalchemy.engine import reflection
+
+from hierarchy import _check_dialect
+
+__all__ = ['HierarchyStats', 'HierarchyWarning', 'execute_instrumented',
+           'explain', 'add_listener', 'remove_listener']
+
+# callables receiving every HierarchyStats built by execute_instrumented
+_listeners = []
+
+# (url, schema, table) already checked for an index on the parent column
+_checked_indexes = {}
+
+class HierarchyWarning(UserWarning):
+    """Warnings about hierarchical queries that are likely to be slow"""
+    pass
+
+class HierarchyStats(object):
+    """What we know about one execution of a Hierarchy:
+        * table: name of the hierarchical table
+        * dialect: name of the dialect used
+        * statement: the compiled sql
+        * compile_time: seconds spent compiling the Hierarchy
+        * execute_time: seconds spent executing it and fetching its rows
+        * rows: number of fetched rows
+        * rows_per_level: dict of level -> number of rows in that level
+        * max_depth: the biggest level found (0 for an empty result)
+    """
+    def __init__(self, table, dialect, statement, compile_time):
+        self.table = table
+        self.dialect = dialect
+        self.statement = statement
+        self.compile_time = compile_time
+        self.execute_time = None
+        self.rows = 0
+        self.rows_per_level = {}
+        self.max_depth = 0
+
+    def __repr__(self):
+        return "HierarchyStats<%s, compile %.6fs, execute %.6fs, %d rows, "\
+               "depth %d>" % (self.table, self.compile_time,
+                              self.execute_time or 0, self.rows,
+                              self.max_depth)
+
+def add_listener(fn):
+    """Register `fn` to be called with the HierarchyStats of every
+    instrumented execution (e.g. to feed a metrics system)"""
+    _listeners.append(fn)
+
+def remove_listener(fn):
+    """Stop calling `fn` for instrumented executions"""
+    _listeners.remove(fn)
+
+def _parent_indexed(conn, table, parent):
+    """Check if the parent column is the leading column of an index, first in
+    the metadata and then asking the database. Results are cached by table
+    since indexes don't come and go between queries."""
+    key = (str(conn.engine.url), table.schema, table.name)
+    if key not in _checked_indexes:
+        found = False
+        for ev in table.indexes:
+            if ev.columns and list(ev.columns)[0].name == parent:
+                found = True
+                break
+        if not found:
+            insp = reflection.Inspector.from_engine(conn)
+            for ev in insp.get_indexes(table.name, schema=table.schema):
+                if ev['column_names'] and ev['column_names'][0] == parent:
+                    found = True
+                    break
+        _checked_indexes[key] = found
+    return _checked_indexes[key]
+
+def _check_parent_index(conn, hierarchy):
+    if not _parent_indexed(conn, hierarchy.table, hierarchy.parent):
+        warnings.warn("Column %s.%s has no index: every recursion step of a "
+                      "Hierarchy will scan the whole table" % \
+                      (hierarchy.table.name, hierarchy.parent),
+                      HierarchyWarning, stacklevel=3)
+
+def execute_instrumented(Session, hierarchy, callback=None,
+                         check_index=True):
+    """Execute `hierarchy` measuring where the time goes. It returns a tuple
+    (rows, stats) where rows is the fetched resultset and stats a
+    HierarchyStats instance.
+    `stats` is passed to `callback` (if any) and to every function registered
+    with add_listener. If `check_index` is true and the parent column of the
+    self referential foreign key has no index, a HierarchyWarning is
+    issued."""
+    conn = Session.connection()
+    if check_index:
+        _check_parent_index(conn, hierarchy)
+    start = time.time()
+    compiled = hierarchy.compile(dialect=conn.dialect)
+    stats = HierarchyStats(hierarchy.table.name, conn.dialect.name,
+                           str(compiled), time.time() - start)
+    start = time.time()
+    rows = conn.execute(compiled).fetchall()
+    stats.execute_time = time.time() - start
+    stats.rows = len(rows)
+    for ev in rows:
+        stats.rows_per_level[ev.level] = \
+                stats.rows_per_level.get(ev.level, 0) + 1
+    if stats.rows_per_level:
+        stats.max_depth = max(stats.rows_per_level)
+    if callback is not None:
+        callback(stats)
+    for fn in _listeners:
+        fn(stats)
+    return rows, stats
+
+def explain(Session, hierarchy, analyze=False):
+    """Return the plan the database uses for `hierarchy` as a list of lines.
+    With `analyze` set to true, pgsql executes the query and reports real
+    timings and row counts (explain analyze). Oracle only supports the
+    estimated plan (explain plan for + dbms_xplan)."""
+    conn = Session.connection()
+    _check_dialect(conn.dialect)
+    compiled = hierarchy.compile(dialect=conn.dialect)
+    params = compiled.construct_params()
+    if conn.dialect.name == 'postgresql':
+        qry = "explain %s%s" % ("analyze " if analyze else "", compiled)
+        return [ev[0] for ev in conn.execute(qry, params).fetchall()]
+    if analyze:
+        raise(NotImplementedError("explain analyze hasn't been written "
+                                  "for %s dialect yet" % \
+                                  (conn.dialect.name)))
+    conn.execute("explain plan for %s" % (compiled), params)
+    return [ev[0] for ev in conn.execute(
+        "select plan_table_output from table(dbms_xplan.display())")]
@@ -0,0 +1,126 @@
+# -*- coding: UTF-8 -*-
+"""Number a hierarchy as nested sets (lft/rgt intervals) so subtrees can be
+read with a range scan"""
+
+from sqlalchemy import Table, Column, Integer
+from sqlalchemy.sql import text
+from sqlalchemy.dialects.postgresql.base import ARRAY
+
+from hierarchy import _find_self_reference, _where_mode
+
+__all__ = ['nested_set_table', 'build_nested_sets']
+
+def nested_set_table(table, metadata=None, name=None,
+                     ordering_colname='ordering'):
+    """Build the side table holding the intervals of the nodes of `table`:
+    the referenced id column (same name and type), lft, rgt, level and the
+    connect_path of every node (plus its `<ordering_colname>_path` if
+    `table` has that column), so Hierarchy can return them without walking
+    the intervals again. Paths are arrays, so the side table is pgsql only.
+    Every node has lft < rgt and the subtree of a node is made of the nodes
+    whose lft is between its lft and rgt. It's named `<table>_nested_set`
+    unless `name` is given, and it belongs to the metadata of `table` unless
+    `metadata` is given. It has no foreign key, so the numbering can be
+    rebuilt at any time without getting in the way of the main table."""
+    parent, child = _find_self_reference(table)
+    if metadata is None:
+        metadata = table.metadata
+    cols = [Column(child, getattr(table.c, child).type, primary_key=True),
+            Column('lft', Integer, nullable=False, index=True),
+            Column('rgt', Integer, nullable=False),
+            Column('level', Integer, nullable=False),
+            Column('connect_path', ARRAY(getattr(table.c, child).type),
+                   nullable=False)]
+    if ordering_colname and ordering_colname in table.c:
+        cols.append(Column('%s_path' % (ordering_colname),
+                           ARRAY(getattr(table.c, ordering_colname).type)))
+    return Table(name or '%s_nested_set' % (table.name), metadata, *cols)
+
+def _insert_rows(Session, table, rows):
+    """Write `rows` (a list of dicts with the same keys) with a single
+    'insert ... values (...), (...)' statement"""
+    preparer = Session.connection().dialect.identifier_preparer
+    names = rows[0].keys()
+    values, params = [], {}
+    for pos, row in enumerate(rows):
+        values.append("(%s)" % (", ".join([":%s_%d" % (ev, pos) \
+                                           for ev in names])))
+        for ev in names:
+            params['%s_%d' % (ev, pos)] = row[ev]
+    Session.execute(text("insert into %s (%s) values %s" % (
+        preparer.format_table(table),
+        ", ".join([preparer.format_column(getattr(table.c, ev)) \
+                   for ev in names]),
+        ", ".join(values))), params)
+
+def build_nested_sets(Session, hierarchy, side_table, batch_size=1000):
+    """Execute `hierarchy` once and write the lft/rgt interval (and the
+    paths) of every returned row to `side_table` (see nested_set_table),
+    replacing its whole content. It returns the number of numbered nodes.
+    Rows come in hierarchical order, so a single pass with a stack of the
+    open ancestors is enough: a node gets its lft when it's read and its rgt
+    once the next node at its level (or above) shows up. Leaves (is_leaf) are
+    closed right away. Rows are fetched in batches of `batch_size` from a
+    server side cursor and written with one delete plus one multi-row insert
+    per batch, so memory only grows with the depth of the tree.
+    The select must include the referenced id column and every node must be
+    returned once and below its parent, so starting_node can't be False and
+    where_mode can't be 'filter'. Each row is checked against its
+    connect_path: siblings sharing an ordering value may have their
+    subtrees mixed, which raises ValueError."""
+    child = hierarchy.child
+    if hierarchy.starting_node is False or hierarchy.max_children or \
+       _where_mode(hierarchy, Session.connection().dialect.name) == \
+       'filter' or \
+       hierarchy.nested_sets is not None:
+        raise(ValueError("Nested sets can only be built from a hierarchy "
+                         "returning every node once, below its parent"))
+    if child not in hierarchy.select.c:
+        raise(ValueError("The select must include the '%s' column to "
+                         "number the hierarchy" % (child)))
+    # the paths the side table keeps
+    paths = [ev for ev in ('connect_path', '%s_path' % (
+        hierarchy.ordering_colname)) if ev in side_table.c]
+    Session.execute(side_table.delete())
+    counter, total, stack, pending = 0, 0, [], []
+    def close(values, lft):
+        values.update({'lft': lft, 'rgt': counter})
+        pending.append(values)
+    rs = Session.execute(hierarchy.execution_options(stream_results=True))
+    while True:
+        rows = rs.fetchmany(batch_size)
+        if not rows:
+            break
+        for row in rows:
+            while stack and stack[-1][0]['level'] >= row.level:
+                counter += 1
+                close(*stack.pop())
+            # what's left in the stack must be the ancestors of the row,
+            # otherwise two subtrees got mixed and their intervals would
+            # overlap
+            if len(stack) != row.level - 1 or (stack and stack[-1][0][child] \
+                                               != row.connect_path[-2]):
+                raise(ValueError("The rows are not in depth first order (%s "
+                                 "comes after another subtree): siblings "
+                                 "must not share an ordering value" % (
+                                     getattr(row, child))))
+            counter += 1
+            values = {child: getattr(row, child), 'level': row.level}
+            for ev in paths:
+                values[ev] = getattr(row, ev)
+            if row.is_leaf:
+                counter += 1
+                close(values, counter - 1)
+            else:
+                stack.append((values, counter))
+        if len(pending) >= batch_size:
+            _insert_rows(Session, side_table, pending)
+            total += len(pending)
+            del pending[:]
+    while stack:
+        counter += 1
+        close(*stack.pop())
+    if pending:
+        _insert_rows(Session, side_table, pending)
+        total += len(pending)
+    return total
@@ -0,0 +1,116 @@
+# -*- coding: UTF-8 -*-
+"""Load mapped instances through a Hierarchy with their self referential
+relationships already populated"""
+
+from sqlalchemy.sql import select as sa_select
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.expression import _UnaryExpression
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm.attributes import set_committed_value, instance_state
+from sqlalchemy.orm.interfaces import MANYTOONE, ONETOMANY
+from sqlalchemy.orm.properties import RelationshipProperty
+from sqlalchemy.orm.exc import UnmappedColumnError
+
+from hierarchy import Hierarchy, _where_mode
+
+__all__ = ['hierarchy_query']
+
+def _self_relationships(mapper):
+    """Return the relationships of `mapper` that point to the same mapper
+    (the 'parent' and 'children' sides of the adjacency list)"""
+    for prop in mapper.iterate_properties:
+        if isinstance(prop, RelationshipProperty) and \
+           prop.mapper is mapper and prop.lazy != 'dynamic':
+            yield prop
+
+def _order_keys(mapper, prop):
+    """Return the order_by of `prop` as a list of (attribute key, descending)
+    or None if it isn't made of plain mapped columns (asc or desc)"""
+    keys = []
+    for ev in prop.order_by or []:
+        descending = False
+        if isinstance(ev, _UnaryExpression) and ev.modifier in (
+            operators.asc_op, operators.desc_op):
+            descending = ev.modifier is operators.desc_op
+            ev = ev.element
+        try:
+            keys.append((mapper.get_property_by_column(ev).key, descending))
+        except UnmappedColumnError:
+            return None
+    return keys
+
+def _sort(nodes, keys):
+    """Sort `nodes` in place by `keys` (see _order_keys). As in the
+    database, nulls go last when ascending and first when descending."""
+    for key, descending in reversed(keys):
+        nodes.sort(key=lambda ev: (getattr(ev, key) is None,
+                                   getattr(ev, key)), reverse=descending)
+
+def _populate(mapper, qry, instances, where_mode):
+    """Fill the self referential relationships of `instances` from the
+    instances themselves, so walking the tree doesn't hit the database.
+    Attributes already loaded (or modified) in the Session are left alone.
+    `where_mode` is the one `qry` used (see hierarchy._where_mode)."""
+    child_key = mapper.get_property_by_column(qry.table.c[qry.child]).key
+    parent_key = mapper.get_property_by_column(qry.table.c[qry.parent]).key
+    by_id, nodes = {}, []
+    for ev in instances:
+        # without a starting node the same row may be returned more than
+        # once
+        if getattr(ev, child_key) not in by_id:
+            by_id[getattr(ev, child_key)] = ev
+            nodes.append(ev)
+    children = dict((k, []) for k in by_id)
+    for ev in nodes:
+        parent_id = getattr(ev, parent_key)
+        if parent_id in children:
+            children[parent_id].append(ev)
+    # if the where clause (or max_children) discarded some rows, we don't
+    # know the full list of children so we leave the collections to the lazy
+    # loader
+    complete = (qry.select._whereclause is None or \
+                where_mode == 'anchor') and not qry.max_children
+    for prop in _self_relationships(mapper):
+        # children come in hierarchy order unless the relationship has an
+        # order_by
+        keys = _order_keys(mapper, prop)
+        for ev in nodes:
+            if prop.key in instance_state(ev).dict:
+                continue
+            if prop.direction is MANYTOONE:
+                parent_id = getattr(ev, parent_key)
+                if parent_id is None:
+                    set_committed_value(ev, prop.key, None)
+                elif parent_id in by_id:
+                    set_committed_value(ev, prop.key, by_id[parent_id])
+            elif prop.direction is ONETOMANY and complete and \
+                 keys is not None:
+                collection = children[getattr(ev, child_key)]
+                if keys:
+                    collection = list(collection)
+                    _sort(collection, keys)
+                set_committed_value(ev, prop.key, collection)
+
+def hierarchy_query(Session, cls, select=None, **kw):
+    """ORM version of Hierarchy: it returns a list of `cls` instances (in the
+    same order Hierarchy returns its rows) loaded with a single recursive
+    query.
+    The self referential relationships of the mapper (many-to-one 'parent'
+    and one-to-many 'children' alike) are populated from the same result
+    set, so walking the loaded tree issues no extra SQL. Parents outside the
+    result set (e.g. the parent of the starting node) and, when the where
+    clause or max_children discard rows, children collections are left to
+    the lazy loader. Children are sorted by the order_by of the
+    relationship, if it has one made of mapped columns (otherwise the
+    collections are left to the lazy loader too).
+    `select` defaults to every column of the mapped table; any other keyword
+    is passed as it is to Hierarchy."""
+    mapper = class_mapper(cls)
+    table = mapper.local_table
+    if select is None:
+        select = sa_select([table])
+    qry = Hierarchy(Session, table, select, **kw)
+    instances = Session.query(cls).from_statement(qry).all()
+    _populate(mapper, qry, instances, _where_mode(
+        qry, Session.connection(mapper=mapper).dialect.name))
+    return instances
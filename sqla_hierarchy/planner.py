@@ -0,0 +1,285 @@
+# -*- coding: UTF-8 -*-
+"""Choose how to execute a Hierarchy from the shape of its tree"""
+
+import time
+
+from sqlalchemy import String
+from sqlalchemy.sql import select, text
+from sqlalchemy.sql.expression import func, literal, literal_column
+from sqlalchemy.util import NamedTuple
+
+from hierarchy import (
+    _find_self_reference, _check_dialect, _sorts_like_pgsql, _where_mode
+)
+from instrument import _parent_indexed
+from subtree import _sql_values
+
+__all__ = ['TreeShape', 'HierarchyPlan', 'HierarchyPlanner', 'strategies']
+
+# recursive: the Hierarchy itself (with recursive / connect by)
+# levels: one 'parent in (...)' query per level, the tree is built in python
+# snapshot: the rows of a HierarchyCache registered in the planner
+strategies = ('recursive', 'levels', 'snapshot')
+
+# ids sent in every 'in (...)' of the levels strategy
+_IN_CHUNK = 1000
+
+def _levels_sql(dialect, table, parent, child, columns, group=False):
+    """Build the sql text selecting `columns` (e.g. "max(level)") over the
+    level of every node reachable from a root (a row with null parent),
+    grouped by level if `group` is set. A node reachable from a root can't
+    belong to a cycle, so no guard is needed."""
+    values = _sql_values(dialect, table, parent, child, columns=columns,
+                         group=" group by level" if group else "")
+    if dialect.name == 'postgresql':
+        return "with recursive lv(%(child)s, level) as (select %(child)s, 1 "\
+               "from %(tb)s where %(parent)s is null union all select "\
+               "hr.%(child)s, lv.level + 1 from %(tb)s hr, lv where "\
+               "hr.%(parent)s=lv.%(child)s) select %(columns)s from "\
+               "lv%(group)s" % values
+    elif dialect.name == 'oracle':
+        return "select %(columns)s from %(tb)s start with %(parent)s is null "\
+               "connect by prior %(child)s=%(parent)s%(group)s" % values
+    raise(NotImplementedError("This method hasn't been written "
+                              "for %s dialect yet" % (dialect.name)))
+
+def _fanout_histogram(Session, table, parent):
+    """dict of number of children -> number of nodes having that many
+    children (leaves are not counted)"""
+    parent_col = getattr(table.c, parent)
+    fanout = select([func.count().label('children')],
+                    parent_col!=None).group_by(parent_col).alias('fanout')
+    return dict(Session.execute(select(
+        [fanout.c.children, func.count()]).group_by(
+            fanout.c.children)).fetchall())
+
+def _percentile(histogram, pct):
+    """Value below which `pct` percent of the counted items fall, for a dict
+    of value -> number of items"""
+    total = sum(histogram.values())
+    if not total:
+        return 0
+    seen = 0
+    for value in sorted(histogram):
+        seen += histogram[value]
+        if seen * 100.0 >= total * pct:
+            return value
+    return max(histogram)
+
+class TreeShape(object):
+    """Cheap statistics about the tree stored in a table:
+        * node_count: number of rows
+        * max_depth: depth of the deepest node reachable from a root
+        * fanout: dict of number of children -> number of nodes with that
+                  many children (leaves are not counted)
+        * parent_indexed: True if the parent column leads an index
+    """
+    def __init__(self, node_count, max_depth, fanout, parent_indexed):
+        self.node_count = node_count
+        self.max_depth = max_depth
+        self.fanout = fanout
+        self.parent_indexed = parent_indexed
+
+    @property
+    def avg_fanout(self):
+        """Average number of children of the nodes that have children"""
+        parents = sum(self.fanout.values())
+        if not parents:
+            return 0.0
+        return sum([k * v for k, v in self.fanout.items()]) / float(parents)
+
+    @property
+    def max_fanout(self):
+        return max(self.fanout or [0])
+
+    def fanout_percentile(self, pct):
+        return _percentile(self.fanout, pct)
+
+    def __repr__(self):
+        return "TreeShape<%d nodes, depth %d, fan-out avg %.1f max %d%s>" % (
+            self.node_count, self.max_depth, self.avg_fanout,
+            self.max_fanout, "" if self.parent_indexed else ", no index")
+
+class HierarchyPlan(object):
+    """The strategy chosen for a Hierarchy and why"""
+    def __init__(self, strategy, reason, shape=None):
+        self.strategy = strategy
+        self.reason = reason
+        self.shape = shape
+
+    def __repr__(self):
+        return "HierarchyPlan<%s: %s>" % (self.strategy, self.reason)
+
+class HierarchyPlanner(object):
+    """Pick an execution strategy for every Hierarchy:
+        * 'snapshot' if a HierarchyCache of the same query was registered
+          with add_snapshot (the caller keeps it fresh with refresh)
+        * 'levels' for shallow trees with a wide fan-out (max depth up to
+          `levels_max_depth` and an average fan-out of at least
+          `levels_min_fanout`) when the parent column is indexed: every
+          level is one indexed 'in (...)' lookup and the tree is built in
+          python, without the sorts the recursive query needs
+        * 'recursive' (the Hierarchy as it is) otherwise
+    The shape of every table is gathered once (see TreeShape) and reused for
+    `max_age` seconds. The levels strategy is only used with pgsql and the
+    default Hierarchy options, and the select must include both columns of
+    the self referential foreign key. Its rows are sorted in python, so the
+    ids must be integers, and so must the ordering column if the select
+    has it (which can't be nullable either).
+    Use plan() to know what would be done and pass `strategy` to plan() or
+    execute() to override the choice."""
+    def __init__(self, max_age=3600, levels_max_depth=4,
+                 levels_min_fanout=50):
+        self.max_age = max_age
+        self.levels_max_depth = levels_max_depth
+        self.levels_min_fanout = levels_min_fanout
+        # table key -> (time gathered, TreeShape)
+        self.shapes = {}
+        # snapshot key -> HierarchyCache
+        self.snapshots = {}
+
+    def _table_key(self, conn, table):
+        return (str(conn.engine.url), table.schema, table.name)
+
+    def _snapshot_key(self, conn, hierarchy):
+        compiled = hierarchy.compile(dialect=conn.dialect)
+        return (self._table_key(conn, hierarchy.table), str(compiled),
+                tuple(sorted(compiled.construct_params().items())))
+
+    def shape(self, Session, table, refresh=False):
+        """Return the TreeShape of `table`, gathering it if it's unknown or
+        older than max_age (or `refresh` is true)"""
+        parent, child = _find_self_reference(table)
+        conn = Session.connection()
+        _check_dialect(conn.dialect)
+        key = self._table_key(conn, table)
+        if refresh or key not in self.shapes or \
+           time.time() - self.shapes[key][0] > self.max_age:
+            node_count = Session.execute(
+                select([func.count()]).select_from(table)).scalar()
+            max_depth = Session.execute(text(_levels_sql(
+                conn.dialect, table, parent, child,
+                "max(level)"))).scalar() or 0
+            self.shapes[key] = (time.time(), TreeShape(
+                node_count, max_depth,
+                _fanout_histogram(Session, table, parent),
+                _parent_indexed(conn, table, parent)))
+        return self.shapes[key][1]
+
+    def add_snapshot(self, Session, cache):
+        """Serve the hierarchy of `cache` (a loaded HierarchyCache) from
+        memory"""
+        self.snapshots[self._snapshot_key(Session.connection(),
+                                          cache.hierarchy)] = cache
+
+    def remove_snapshot(self, Session, cache):
+        self.snapshots.pop(self._snapshot_key(Session.connection(),
+                                              cache.hierarchy), None)
+
+    def _levels_allowed(self, conn, hierarchy):
+        return conn.dialect.name == 'postgresql' and \
+               _sorts_like_pgsql(hierarchy) and \
+               _where_mode(hierarchy, conn.dialect.name) == 'prune' and \
+               not hierarchy.max_children and \
+               hierarchy.path_encoding == 'array' and \
+               hierarchy.starting_node is not False and \
+               hierarchy.child in hierarchy.select.c and \
+               hierarchy.parent in hierarchy.select.c
+
+    def plan(self, Session, hierarchy, strategy=None):
+        """Return the HierarchyPlan for `hierarchy`. If `strategy` is given
+        it's used as it is, raising ValueError if it can't be used for this
+        Hierarchy"""
+        conn = Session.connection()
+        _check_dialect(conn.dialect)
+        if strategy is not None:
+            if strategy not in strategies:
+                raise(ValueError("strategy must be one of %s" % \
+                                 (", ".join(strategies))))
+            if strategy == 'snapshot' and self._snapshot_key(
+                conn, hierarchy) not in self.snapshots:
+                raise(ValueError("No snapshot was registered for this "
+                                 "hierarchy"))
+            if strategy == 'levels' and \
+               not self._levels_allowed(conn, hierarchy):
+                raise(ValueError("The levels strategy can't be used with "
+                                 "this hierarchy"))
+            return HierarchyPlan(strategy, "requested by the caller")
+        if self._snapshot_key(conn, hierarchy) in self.snapshots:
+            return HierarchyPlan('snapshot', "a snapshot is registered")
+        if not self._levels_allowed(conn, hierarchy):
+            return HierarchyPlan('recursive', "only strategy available for "
+                                 "this hierarchy")
+        shape = self.shape(Session, hierarchy.table)
+        if shape.parent_indexed and \
+           shape.max_depth <= self.levels_max_depth and \
+           shape.avg_fanout >= self.levels_min_fanout:
+            return HierarchyPlan('levels', "shallow tree (depth %d) with a "
+                                 "wide fan-out (%.1f)" % (
+                                     shape.max_depth, shape.avg_fanout),
+                                 shape)
+        return HierarchyPlan('recursive', "depth %d, average fan-out %.1f%s" %\
+                             (shape.max_depth, shape.avg_fanout,
+                              "" if shape.parent_indexed else \
+                              ", parent column not indexed"), shape)
+
+    def execute(self, Session, hierarchy, strategy=None):
+        """Execute `hierarchy` with the planned (or given) strategy. It
+        returns a tuple (rows, plan). Rows are sorted and labeled as the
+        Hierarchy returns them, whatever the strategy."""
+        plan = self.plan(Session, hierarchy, strategy)
+        if plan.strategy == 'snapshot':
+            rows = self.snapshots[self._snapshot_key(
+                Session.connection(), hierarchy)].ordered_rows()
+        elif plan.strategy == 'levels':
+            rows = _execute_levels(Session, hierarchy)
+        else:
+            rows = Session.execute(hierarchy).fetchall()
+        return rows, plan
+
+def _execute_levels(Session, h):
+    """Walk the tree one level at a time with 'parent in (...)' queries and
+    build the same rows the pgsql Hierarchy returns"""
+    parent_col = getattr(h.table.c, h.parent)
+    labels = [ev.name for ev in h.columns]
+    ordering_path = '%s_path' % (h.ordering_colname)
+    if ordering_path not in labels:
+        ordering_path = None
+    # same condition visit_hierarchy uses for the starting node
+    val = h.fk_type == String and "a" or "0"
+    rows = [dict(zip(ev.keys(), ev)) for ev in Session.execute(
+        h.select.where(func.coalesce(
+            literal_column(h.parent, type_=String),
+            literal(val, type_=String))==\
+            literal(h.starting_node, type_=String)))]
+    for ev in rows:
+        ev['level'] = 1
+        ev['connect_path'] = [ev[h.child]]
+        ev['cycle'] = False
+        if ordering_path:
+            ev[ordering_path] = [ev[h.ordering_colname]]
+    current, has_children = rows, set()
+    while current:
+        # as in the recursive query, a node closing a cycle is returned but
+        # not expanded
+        by_id = dict((ev[h.child], ev) for ev in current if not ev['cycle'])
+        ids, current = by_id.keys(), []
+        for pos in range(0, len(ids), _IN_CHUNK):
+            for ev in Session.execute(h.select.where(
+                parent_col.in_(ids[pos:pos + _IN_CHUNK]))):
+                row = dict(zip(ev.keys(), ev))
+                parent = by_id[row[h.parent]]
+                has_children.add(id(parent))
+                row['level'] = parent['level'] + 1
+                row['cycle'] = row[h.child] in parent['connect_path']
+                row['connect_path'] = parent['connect_path'] + \
+                        [row[h.child]]
+                if ordering_path:
+                    row[ordering_path] = parent[ordering_path] + \
+                            [row[h.ordering_colname]]
+                current.append(row)
+        rows.extend(current)
+    for ev in rows:
+        ev['is_leaf'] = id(ev) not in has_children
+    rows.sort(key=lambda ev: ev[ordering_path or 'connect_path'])
+    return [NamedTuple([ev[k] for k in labels], labels) for ev in rows]
@@ -0,0 +1,210 @@
+# -*- coding: UTF-8 -*-
+"""Profile the shape of the tree stored in a self referential table and
+look for rows breaking it (orphans and cycles)"""
+
+from sqlalchemy.sql import select, text, exists, and_
+from sqlalchemy.sql.expression import func
+
+from subtree import _prepare, _sql_values
+from planner import _fanout_histogram, _percentile, _levels_sql
+
+__all__ = ['TreeProfile', 'scan_tree']
+
+def _largest_sql(dialect, table, parent, child, levels, top):
+    """Build the sql text returning (id, subtree size) of the `top` biggest
+    subtrees whose root is at most at level `levels`. Every node is counted
+    once for each of its ancestors up to that level, so the cost grows with
+    `levels` instead of with the depth of the tree."""
+    values = _sql_values(dialect, table, parent, child, levels=int(levels),
+                         top=int(top))
+    if dialect.name == 'postgresql':
+        return "with recursive lv(%(child)s, level) as (select %(child)s, 1 "\
+               "from %(tb)s where %(parent)s is null union all select "\
+               "hr.%(child)s, lv.level + 1 from %(tb)s hr, lv where "\
+               "hr.%(parent)s=lv.%(child)s and lv.level < %(levels)d), "\
+               "walk(top, %(child)s) as (select %(child)s, %(child)s from lv "\
+               "union all select walk.top, hr.%(child)s from %(tb)s hr, walk "\
+               "where hr.%(parent)s=walk.%(child)s) select top, count(*) "\
+               "from walk group by top order by 2 desc limit %(top)d" % values
+    return "select * from (select connect_by_root %(child)s, count(*) from "\
+           "%(tb)s start with %(child)s in (select %(child)s from %(tb)s "\
+           "where level <= %(levels)d start with %(parent)s is null connect "\
+           "by prior %(child)s=%(parent)s) connect by prior "\
+           "%(child)s=%(parent)s group by connect_by_root %(child)s order by "\
+           "2 desc) where rownum <= %(top)d" % values
+
+def _unreachable_sql(dialect, table, parent, child):
+    """Build the sql text returning (id, parent) of the rows that can't be
+    reached from a root nor from an orphan: they belong to a cycle or hang
+    from one"""
+    values = _sql_values(dialect, table, parent, child)
+    entry = "%(parent)s is null or not exists (select 1 from %(tb)s p where "\
+            "p.%(child)s=%(tb)s.%(parent)s)" % values
+    values['entry'] = entry
+    if dialect.name == 'postgresql':
+        return "with recursive reach(%(child)s) as (select %(child)s from "\
+               "%(tb)s where %(entry)s union all select hr.%(child)s from "\
+               "%(tb)s hr, reach where hr.%(parent)s=reach.%(child)s) select "\
+               "%(child)s, %(parent)s from %(tb)s where not exists (select 1 "\
+               "from reach where reach.%(child)s=%(tb)s.%(child)s)" % values
+    return "select %(child)s, %(parent)s from %(tb)s where %(child)s not in "\
+           "(select %(child)s from %(tb)s start with %(entry)s connect by "\
+           "prior %(child)s=%(parent)s)" % values
+
+def _cycle_rows(Session, dialect, table, parent, child, batch_size):
+    """Return the number of unreachable rows (see _unreachable_sql) and a
+    dict id -> parent of the ones on a cycle. The rows hanging from a cycle
+    are dropped by the database: pgsql copies the unreachable rows to a
+    temporary table and deletes the ones nobody points to until none is
+    left (every row on a cycle is the parent of another one), oracle walks
+    up from each of them and keeps the rows connect by flags as closing a
+    cycle (a temporary table would need ddl, which commits)."""
+    values = _sql_values(dialect, table, parent, child,
+                         tmp='sqla_hierarchy_unreachable',
+                         unreachable=_unreachable_sql(dialect, table, parent,
+                                                      child))
+    if dialect.name == 'postgresql':
+        Session.execute(text("create temporary table %(tmp)s on commit drop "
+                             "as %(unreachable)s" % values))
+        try:
+            count = Session.execute(text("select count(*) from %(tmp)s" % \
+                                         values)).scalar()
+            while count and Session.execute(text(
+                "delete from %(tmp)s u where not exists (select 1 from "
+                "%(tmp)s c where c.%(parent)s=u.%(child)s)" % \
+                values)).rowcount:
+                pass
+            parents = _cycle_parents(Session, count, "select %(child)s, "
+                                     "%(parent)s from %(tmp)s" % values,
+                                     batch_size)
+        finally:
+            Session.execute(text("drop table %(tmp)s" % values))
+    else:
+        count = Session.execute(text("select count(*) from (%(unreachable)s)"\
+                                     % values)).scalar()
+        parents = _cycle_parents(Session, count, "select distinct %(child)s, "
+                                 "%(parent)s from %(tb)s where "
+                                 "connect_by_iscycle=1 start with %(child)s "
+                                 "in (select %(child)s from (%(unreachable)s))"
+                                 " connect by nocycle prior "
+                                 "%(parent)s=%(child)s" % values, batch_size)
+    return count, parents
+
+def _cycle_parents(Session, count, cycles, batch_size):
+    """dict id -> parent of the rows returned by the `cycles` sql text, read
+    in batches of `batch_size` from a server side cursor"""
+    parents = {}
+    if count:
+        rs = Session.execute(text(cycles).execution_options(
+            stream_results=True))
+        while True:
+            rows = rs.fetchmany(batch_size)
+            if not rows:
+                break
+            parents.update(rows)
+    return parents
+
+def _find_cycles(parents, max_cycles):
+    """Return the cycles (lists of ids, starting by the smallest one) of a
+    dict id -> parent id where every walk up ends in a cycle"""
+    cycles, done = [], set()
+    for start in parents:
+        walk, seen = [], {}
+        node = start
+        while node in parents and node not in done and node not in seen:
+            seen[node] = len(walk)
+            walk.append(node)
+            node = parents[node]
+        if node in seen:
+            cycle = walk[seen[node]:]
+            first = cycle.index(min(cycle))
+            cycles.append(cycle[first:] + cycle[:first])
+            if len(cycles) >= max_cycles:
+                break
+        done.update(walk)
+    return cycles
+
+class TreeProfile(object):
+    """What scan_tree found in a table:
+        * table: name of the table
+        * node_count: number of rows
+        * depth_histogram: dict of level -> number of nodes reachable from a
+                           root at that level
+        * max_depth: the biggest level in depth_histogram
+        * fanout: dict of number of children -> number of nodes with that
+                  many children
+        * fanout_percentiles: dict of percentile -> number of children (only
+                              nodes having children are counted)
+        * orphan_count: rows whose parent doesn't exist
+        * orphans: some of those rows (up to `sample_size` ids)
+        * cycles: the cycles found (lists of ids, up to `max_cycles`)
+        * unreachable: number of rows belonging to a cycle or hanging from
+                       one
+        * largest_subtrees: list of (id, size) of the biggest subtrees
+    """
+    def __init__(self, table):
+        self.table = table
+        self.node_count = 0
+        self.depth_histogram = {}
+        self.max_depth = 0
+        self.fanout = {}
+        self.fanout_percentiles = {}
+        self.orphan_count = 0
+        self.orphans = []
+        self.cycles = []
+        self.unreachable = 0
+        self.largest_subtrees = []
+
+    @property
+    def ok(self):
+        """True if the table holds a proper forest (no orphans nor cycles)"""
+        return not self.orphan_count and not self.unreachable
+
+    def __repr__(self):
+        return "TreeProfile<%s, %d nodes, depth %d, %d orphans, %d cycles>" %\
+               (self.table, self.node_count, self.max_depth,
+                self.orphan_count, len(self.cycles))
+
+def scan_tree(Session, table, top=10, subtree_levels=2, sample_size=100,
+              max_cycles=100, percentiles=(50, 90, 99, 100),
+              batch_size=10000):
+    """Profile the tree stored in `table` and check its integrity, returning
+    a TreeProfile.
+    Everything is aggregated by the database (a handful of statements, the
+    recursive ones only follow rows reachable from a root, so they can't
+    loop), so memory doesn't grow with the table. Rows that can't be reached
+    from a root nor from an orphan are in or below a cycle: the database
+    drops the ones below (see _cycle_rows) and only the rows on a cycle are
+    brought to python, in batches of `batch_size` from a server side cursor,
+    to tell the cycles apart.
+    Largest subtrees are looked for among the nodes up to `subtree_levels`
+    (the deeper, the more expensive) and the `top` biggest are returned."""
+    dialect, parent, child = _prepare(Session, table)
+    parent_col = getattr(table.c, parent)
+    child_col = getattr(table.c, child)
+    profile = TreeProfile(table.name)
+    profile.node_count = Session.execute(
+        select([func.count()]).select_from(table)).scalar()
+    profile.depth_histogram = dict(Session.execute(text(_levels_sql(
+        dialect, table, parent, child, "level, count(*)",
+        group=True))).fetchall())
+    profile.max_depth = max(profile.depth_histogram or [0])
+    profile.fanout = _fanout_histogram(Session, table, parent)
+    profile.fanout_percentiles = dict((pct, _percentile(profile.fanout, pct))\
+                                      for pct in percentiles)
+    # a foreign key prevents orphans, unless it was disabled or deferred
+    p = table.alias('p')
+    orphan = and_(parent_col!=None,
+                  ~exists([getattr(p.c, child)],
+                          getattr(p.c, child)==parent_col))
+    profile.orphan_count = Session.execute(
+        select([func.count()], orphan, from_obj=[table])).scalar()
+    if profile.orphan_count:
+        profile.orphans = [ev[0] for ev in Session.execute(select(
+            [child_col], orphan).order_by(child_col).limit(sample_size))]
+    profile.unreachable, parents = _cycle_rows(Session, dialect, table,
+                                               parent, child, batch_size)
+    profile.cycles = _find_cycles(parents, max_cycles)
+    profile.largest_subtrees = [tuple(ev) for ev in Session.execute(text(
+        _largest_sql(dialect, table, parent, child, subtree_levels, top)))]
+    return profile
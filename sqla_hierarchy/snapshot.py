@@ -0,0 +1,192 @@
+# -*- coding: UTF-8 -*-
+"""Flat, memory mapped snapshots of a Hierarchy that several processes can
+share"""
+
+import os
+import mmap
+import struct
+import tempfile
+import time
+
+from export import hierarchy_arrays, _import_numpy
+from hierarchy import _where_mode
+
+__all__ = ['write_snapshot', 'HierarchySnapshot']
+
+# magic, format version, id width (0 for int64 ids, otherwise the size of
+# the utf-8 encoded ids), rows, children entries, creation time
+_HEADER = struct.Struct('<8sIIqqd')
+_MAGIC = 'SQLAHSNP'
+_VERSION = 1
+# every array starts at a multiple of this
+_ALIGN = 64
+
+def _layout(numpy, id_width, rows, children):
+    """Name, dtype, size and offset of every array in the file, in order"""
+    id_dtype = numpy.dtype('<i8') if not id_width else \
+            numpy.dtype('S%d' % (id_width))
+    sections = [('parent', numpy.dtype('<i8'), rows),
+                ('level', numpy.dtype('<i4'), rows),
+                ('is_leaf', numpy.dtype(numpy.bool_), rows),
+                ('child_offsets', numpy.dtype('<i8'), rows + 1),
+                ('child_index', numpy.dtype('<i8'), children),
+                ('id_order', numpy.dtype('<i8'), rows),
+                ('id', id_dtype, rows)]
+    layout, offset = [], _ALIGN
+    for name, dtype, count in sections:
+        layout.append((name, dtype, count, offset))
+        offset += dtype.itemsize * count
+        offset += -offset % _ALIGN
+    return layout, offset
+
+def write_snapshot(Session, hierarchy, path, batch_size=10000):
+    """Execute `hierarchy` once (see hierarchy_arrays, numpy is required) and
+    write it to `path` as a flat file HierarchySnapshot can map. It holds,
+    one element per row and in the order the Hierarchy returned them:
+        * parent: position of the parent row (-1 for the roots)
+        * level and is_leaf: as returned by the Hierarchy
+        * child_offsets/child_index: children of row i are the positions
+          child_index[child_offsets[i]:child_offsets[i + 1]]
+        * id: integer ids as int64, any other id as utf-8 bytes
+        * id_order: positions sorted by id, to find a row by id with a
+          binary search
+    The file is written next to `path` under a temporary name and renamed
+    over it, so processes opening `path` always find a complete snapshot
+    (rename is atomic on POSIX systems). It returns the number of rows.
+    subtree() expects every returned row to come with its ancestors, so
+    where_mode can't be 'filter'."""
+    if _where_mode(hierarchy, Session.connection().dialect.name) == 'filter':
+        raise(ValueError("A snapshot can't be built from a hierarchy with "
+                         "where_mode='filter'"))
+    numpy = _import_numpy()
+    arrays = hierarchy_arrays(Session, hierarchy, batch_size=batch_size)
+    rows = len(arrays)
+    ids = arrays.id
+    id_width = 0
+    if ids.dtype.kind not in 'iu':
+        ids = [unicode(ev).encode('utf-8') for ev in ids]
+        id_width = max([len(ev) for ev in ids] or [1]) or 1
+        ids = numpy.array(ids, dtype='S%d' % (id_width))
+    positions = numpy.arange(rows, dtype=numpy.int64)
+    has_parent = arrays.parent >= 0
+    parents = arrays.parent[has_parent]
+    # a stable sort keeps the siblings in the order of the hierarchy
+    child_index = positions[has_parent][numpy.argsort(parents,
+                                                      kind='mergesort')]
+    child_offsets = numpy.zeros(rows + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(parents, minlength=rows),
+                 out=child_offsets[1:])
+    values = {'parent': arrays.parent, 'level': arrays.level,
+              'is_leaf': arrays.is_leaf, 'child_offsets': child_offsets,
+              'child_index': child_index,
+              'id_order': numpy.argsort(ids, kind='mergesort'), 'id': ids}
+    layout, size = _layout(numpy, id_width, rows, len(child_index))
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.snapshot')
+    try:
+        out = os.fdopen(fd, 'wb')
+        out.write(_HEADER.pack(_MAGIC, _VERSION, id_width, rows,
+                               len(child_index), time.time()))
+        for name, dtype, count, offset in layout:
+            out.seek(offset)
+            out.write(numpy.ascontiguousarray(values[name],
+                                              dtype=dtype).tostring())
+        out.truncate(size)
+        out.flush()
+        os.fsync(out.fileno())
+        out.close()
+        os.rename(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return rows
+
+class HierarchySnapshot(object):
+    """Read only view of a file written by write_snapshot. The file is mapped
+    in memory and every attribute (parent, level, is_leaf, child_offsets,
+    child_index, id_order, id) is a numpy array over that mapping: nothing is
+    copied, so every process mapping the same file shares the same pages.
+    When the file is replaced by a new version, reload() maps the new one;
+    the previous mapping stays valid until this object drops it."""
+    def __init__(self, path):
+        self.path = path
+        self.numpy = _import_numpy()
+        self._map()
+
+    def _map(self):
+        numpy = self.numpy
+        fp = open(self.path, 'rb')
+        try:
+            self.stat = os.fstat(fp.fileno())
+            self.mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fp.close()
+        magic, version, id_width, rows, children, self.created = \
+                _HEADER.unpack_from(self.mmap)
+        if magic != _MAGIC or version != _VERSION:
+            raise(ValueError("%s is not a hierarchy snapshot" % (self.path)))
+        self.encoded_ids = bool(id_width)
+        layout, size = _layout(numpy, id_width, rows, children)
+        for name, dtype, count, offset in layout:
+            setattr(self, name, numpy.frombuffer(self.mmap, dtype=dtype,
+                                                 count=count, offset=offset))
+
+    def __len__(self):
+        return len(self.id)
+
+    def is_stale(self):
+        """True if `path` was replaced since it was mapped"""
+        stat = os.stat(self.path)
+        return (stat.st_ino, stat.st_mtime) != (self.stat.st_ino,
+                                                self.stat.st_mtime)
+
+    def reload(self):
+        """Map the file again if it was replaced. It returns True if it
+        did"""
+        if not self.is_stale():
+            return False
+        self._map()
+        return True
+
+    def node_id(self, position):
+        """The id of the row at `position`"""
+        value = self.id[position]
+        if self.encoded_ids:
+            return value.decode('utf-8')
+        return int(value)
+
+    def position(self, node):
+        """Position of the row whose id is `node` (KeyError if absent)"""
+        if self.encoded_ids:
+            node = unicode(node).encode('utf-8')
+        pos = self.numpy.searchsorted(self.id, node, sorter=self.id_order)
+        if pos < len(self) and self.id[self.id_order[pos]] == node:
+            return int(self.id_order[pos])
+        raise(KeyError(node))
+
+    def children(self, node):
+        """Ids of the children of `node`, in hierarchy order"""
+        pos = self.position(node)
+        return [self.node_id(ev) for ev in self.child_index[
+            self.child_offsets[pos]:self.child_offsets[pos + 1]]]
+
+    def ancestors(self, node):
+        """Ids from the root down to the parent of `node`"""
+        path = []
+        pos = self.parent[self.position(node)]
+        while pos >= 0:
+            path.append(self.node_id(pos))
+            pos = self.parent[pos]
+        path.reverse()
+        return path
+
+    def subtree(self, node):
+        """Positions of the descendants of `node`: rows are in depth first
+        order, so they are the rows right after it until the level goes
+        back to its own"""
+        pos = self.position(node)
+        below = self.level[pos + 1:] <= self.level[pos]
+        end = pos + 1 + (self.numpy.argmax(below) if below.any() \
+                         else len(below))
+        return self.numpy.arange(pos + 1, end)
@@ -0,0 +1,168 @@
+# -*- coding: UTF-8 -*-
+"""Set based operations over a whole subtree (delete, move, copy)"""
+
+from sqlalchemy import Integer
+from sqlalchemy.sql import select, text
+from sqlalchemy.sql.expression import func
+
+from hierarchy import (
+    HierarchyCycleError, _find_self_reference, _check_dialect
+)
+
+__all__ = ['delete_subtree', 'move_subtree', 'copy_subtree']
+
+def _sql_values(dialect, table, parent, child, **kw):
+    """Names used to build sql text: the table (as 'tb') and the parent and
+    child columns, quoted for `dialect`, plus anything else in `kw`"""
+    preparer = dialect.identifier_preparer
+    values = {'tb': preparer.format_table(table),
+              'parent': preparer.quote(parent, table.c[parent].quote),
+              'child': preparer.quote(child, table.c[child].quote)}
+    values.update(kw)
+    return values
+
+def _subtree_sql(dialect, table, parent, child, bind='node'):
+    """Build the sql text returning the ids of the subtree whose root is the
+    value of the `bind` parameter (the root itself included).
+    For pgsql we use the same 'with recursive' idiom visit_hierarchy does,
+    but with a plain union instead of union all: the recursion stops as soon
+    as an id has already been visited, so a cycle can't loop forever.
+    For oracle we use connect by."""
+    values = _sql_values(dialect, table, parent, child, bind=bind)
+    if dialect.name == 'postgresql':
+        return "with recursive sub(%(child)s) as (select %(child)s from "\
+               "%(tb)s where %(child)s=:%(bind)s union select "\
+               "hr.%(child)s from %(tb)s hr, sub where hr.%(parent)s="\
+               "sub.%(child)s) select %(child)s from sub" % values
+    elif dialect.name == 'oracle':
+        return "select %(child)s from %(tb)s start with %(child)s="\
+               ":%(bind)s connect by nocycle prior %(child)s=%(parent)s" %\
+               values
+    raise(NotImplementedError("This method hasn't been written "
+                              "for %s dialect yet" % (dialect.name)))
+
+def _lineage_sql(dialect, table, parent, child, bind='node'):
+    """Build the sql text returning the id of the `bind` node and the ids of
+    all its ancestors (same guards against cycles as _subtree_sql)"""
+    values = _sql_values(dialect, table, parent, child, bind=bind)
+    if dialect.name == 'postgresql':
+        return "with recursive up(%(child)s, %(parent)s) as (select "\
+               "%(child)s, %(parent)s from %(tb)s where %(child)s=:%(bind)s "\
+               "union select hr.%(child)s, hr.%(parent)s from %(tb)s hr, up "\
+               "where hr.%(child)s=up.%(parent)s) select %(child)s from up" %\
+               values
+    elif dialect.name == 'oracle':
+        return "select %(child)s from %(tb)s start with %(child)s="\
+               ":%(bind)s connect by nocycle prior %(parent)s=%(child)s" %\
+               values
+    raise(NotImplementedError("This method hasn't been written "
+                              "for %s dialect yet" % (dialect.name)))
+
+def _prepare(Session, table):
+    """Common checks for every subtree operation. Returns the dialect in use
+    plus the (parent, child) names of the self referential foreign key"""
+    parent, child = _find_self_reference(table)
+    # we ask for the connection so the dialect knows the server version
+    dialect = Session.connection().dialect
+    _check_dialect(dialect)
+    return dialect, parent, child
+
+def delete_subtree(Session, table, node):
+    """Delete `node` and every one of its descendants with a single
+    'delete ... where id in (subtree)' statement. It returns the number of
+    deleted rows.
+    Since the rows never pass through the ORM, mapped instances already
+    loaded in the Session are not aware of the deletion: expire them if you
+    are going to keep using them."""
+    dialect, parent, child = _prepare(Session, table)
+    qry = "delete from %s where %s in (%s)" % (
+        dialect.identifier_preparer.format_table(table),
+        _sql_values(dialect, table, parent, child)['child'],
+        _subtree_sql(dialect, table, parent, child))
+    return Session.execute(text(qry), {'node': node}).rowcount
+
+def move_subtree(Session, table, node, new_parent):
+    """Re-parent `node` (and with it, its whole subtree) below `new_parent`.
+    Only the root of the subtree needs to be updated, so this is a single
+    update no matter how big the subtree is. If `new_parent` belongs to the
+    subtree of `node` the move would create a cycle and HierarchyCycleError
+    is raised: the update itself checks it ('... where id=:node and
+    :new_parent not in (subtree)').
+    That check reads the rows as they were when the update started, so two
+    concurrent moves (a below b and b below a) could both pass it. Before
+    updating, `node` and the ancestors of `new_parent` are locked with a
+    'select ... for update': of two such moves, one waits for the other to
+    commit and then sees its result (or the database reports a deadlock).
+    The locks are held until the transaction ends.
+    Pass None as `new_parent` to turn `node` into a root.
+    It returns the number of updated rows (0 if `node` doesn't exist)."""
+    dialect, parent, child = _prepare(Session, table)
+    if new_parent is None:
+        upd = table.update(getattr(table.c, child)==node,
+                           values={parent: new_parent})
+        return Session.execute(upd).rowcount
+    values = _sql_values(dialect, table, parent, child,
+                         lineage=_lineage_sql(dialect, table, parent, child,
+                                              bind='new_parent'),
+                         subtree=_subtree_sql(dialect, table, parent, child))
+    params = {'node': node, 'new_parent': new_parent}
+    Session.execute(text("select %(child)s from %(tb)s where "
+                         "%(child)s=:node or %(child)s in (%(lineage)s) for "
+                         "update" % values), params).fetchall()
+    rowcount = Session.execute(text(
+        "update %(tb)s set %(parent)s=:new_parent where %(child)s=:node and "
+        ":new_parent not in (%(subtree)s)" % values), params).rowcount
+    if not rowcount and Session.execute(text(
+        "select count(*) from %(tb)s where %(child)s=:node" % values),
+        params).scalar():
+        # the node exists, so the guard refused the move
+        raise(HierarchyCycleError(table.name, node, new_parent))
+    return rowcount
+
+def copy_subtree(Session, table, node, new_parent, id_offset=None):
+    """Copy `node` and its whole subtree below `new_parent` with a single
+    'insert ... select' statement.
+    Ids are remapped by adding the same offset to every copied id (and to
+    every copied parent, except for the root of the copy which gets
+    `new_parent`), so the copied subtree keeps its shape. If `id_offset` is
+    not provided we use the smallest offset that places every new id above
+    the current max(id) of the table. It returns the offset used, so the new
+    id of any copied node is `old_id + offset`.
+    Only integer ids are supported (NotImplementedError otherwise). Any
+    other column is copied as it is, so unique constraints on those columns
+    will make the copy fail. If the ids come from a sequence, remember to
+    move it past the new max(id)."""
+    dialect, parent, child = _prepare(Session, table)
+    if getattr(table.c, child).type._type_affinity is not Integer:
+        raise(NotImplementedError("copy_subtree only knows how to remap "
+                                  "integer ids"))
+    sub = _subtree_sql(dialect, table, parent, child)
+    preparer = dialect.identifier_preparer
+    values = _sql_values(dialect, table, parent, child)
+    if id_offset is None:
+        max_id = Session.execute(
+            select([func.max(getattr(table.c, child))])).scalar()
+        min_id = Session.execute(
+            text("select min(%s) from (%s) sub_min" % (values['child'],
+                                                        sub)),
+            {'node': node}).scalar()
+        if min_id is None:
+            # nothing to copy
+            return 0
+        id_offset = max_id - min_id + 1
+    cols, exprs = [], []
+    for ev in table.c:
+        cols.append(preparer.format_column(ev))
+        if ev.name == child:
+            exprs.append("%(child)s + :offset" % values)
+        elif ev.name == parent:
+            exprs.append("case when %(child)s=:node then :new_parent else "
+                         "%(parent)s + :offset end" % values)
+        else:
+            exprs.append(preparer.format_column(ev))
+    qry = "insert into %s (%s) select %s from %s where %s in (%s)" % (
+        values['tb'], ", ".join(cols), ", ".join(exprs), values['tb'],
+        values['child'], sub)
+    Session.execute(text(qry), {'node': node, 'new_parent': new_parent,
+                                'offset': id_offset})
+    return id_offset
@@ -250,6 +250,31 @@ class TestHierarchy(object):
         ok_(expected==real, "We expect to get only the active nodes but we get "
                        "everything. Expected: %s, Got: %s" % (expected, real))
 
+    def test10_where_mode(self):
+        """Hierarchy oracle: the where clause filters the output unless we
+        ask to prune the tree"""
+        DBSession.query(Dummy).get(9).active = False
+        DBSession.flush()
+        sel = select([dummy_tb.c.id], dummy_tb.c.active==True)
+        real = [v[0] for v in DBSession.execute(Hierarchy(
+            DBSession, dummy_tb, sel)).fetchall()]
+        real.sort()
+        eq_(real, [1, 2, 3, 4, 5, 6, 7, 8, 10, 11, 12])
+        real = [v[0] for v in DBSession.execute(Hierarchy(
+            DBSession, dummy_tb, sel, where_mode='prune')).fetchall()]
+        real.sort()
+        eq_(real, [1, 2, 3, 4, 5, 6, 7, 8, 10, 12])
+        DBSession.rollback()
+        # the default is chosen when compiling, whatever the session is
+        # bound to
+        conn = engine.connect()
+        try:
+            qry = Hierarchy(sessionmaker(bind=conn)(), dummy_tb, sel)
+            ok_("start with parent_id is null connect by prior id=parent_id"\
+                in str(qry.compile(bind=conn)))
+        finally:
+            conn.close()
+
     def test9_dialect(self):
         """Hierarchy oracle: check the supported version"""
         DBSession.bind.dialect.server_version_info = Mock(return_value=(9,0,0))
@@ -0,0 +1,75 @@
+# -*- coding: UTF-8 -*-
+""""Testing ancestor/descendant checks"""
+from nose.tools import *
+
+from sqlalchemy import Table, Column, ForeignKey, MetaData
+from sqlalchemy import Integer, Unicode
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqla_hierarchy import *
+
+from tests import get_engine
+
+DBSession = scoped_session(sessionmaker())
+metadata = MetaData()
+engine = get_engine('pg-db')
+DBSession.configure(bind=engine)
+metadata.bind = engine
+
+ancestry_tb = Table('ancestry_hierarchy', metadata,
+                    Column('id', Integer, primary_key=True),
+                    Column('name', Unicode(10)),
+                    Column('parent_id', Integer,
+                           ForeignKey('ancestry_hierarchy.id'), index=True)
+                   )
+
+ancestry_values = {1:None, 2:1, 3:1, 4:2, 5:3, 7:3, 9:3, 6:4, 11:9, 8:6,
+                   10:8, 12:8, 13:None}
+
+def setup():
+    """Same tree we use in test_pg plus a second root (13)"""
+    ancestry_tb.drop(checkfirst=True)
+    ancestry_tb.create(checkfirst=True)
+    DBSession.execute(ancestry_tb.insert(),
+                      [{'id':k, 'name':u'item %d' % k, 'parent_id':v} \
+                       for k, v in sorted(ancestry_values.items())])
+    DBSession.commit()
+
+def teardown():
+    ancestry_tb.drop(checkfirst=True)
+
+class TestAncestry(object):
+
+    def test1_is_descendant(self):
+        """Ancestry pgsql: is x under y?"""
+        ok_(is_descendant(DBSession, ancestry_tb, 10, 2))
+        ok_(is_descendant(DBSession, ancestry_tb, 10, 1))
+        ok_(not is_descendant(DBSession, ancestry_tb, 10, 3))
+        ok_(not is_descendant(DBSession, ancestry_tb, 2, 2))
+        ok_(not is_descendant(DBSession, ancestry_tb, 2, 10))
+
+    def test2_are_descendants(self):
+        """Ancestry pgsql: many pairs in one round trip"""
+        eq_(are_descendants(DBSession, ancestry_tb,
+                            [(10, 2), (10, 3), (11, 3), (99, 1), (13, 1)]),
+            [True, False, True, False, False])
+
+    def test2_are_descendants_same_node(self):
+        """Ancestry pgsql: the same node checked against many others"""
+        eq_(are_descendants(DBSession, ancestry_tb,
+                            [(10, 1), (10, 4), (10, 3), (10, 8)]),
+            [True, True, False, True])
+
+    def test3_lowest_common_ancestor(self):
+        """Ancestry pgsql: lowest common ancestor"""
+        eq_(lowest_common_ancestor(DBSession, ancestry_tb, 10, 12), 8)
+        eq_(lowest_common_ancestor(DBSession, ancestry_tb, 11, 6), 1)
+        eq_(lowest_common_ancestor(DBSession, ancestry_tb, 10, 4), 4)
+        eq_(lowest_common_ancestor(DBSession, ancestry_tb, 10, 13), None)
+
+    def test4_path_between(self):
+        """Ancestry pgsql: path between two nodes"""
+        eq_(path_between(DBSession, ancestry_tb, 10, 4), [10, 8, 6, 4])
+        eq_(path_between(DBSession, ancestry_tb, 4, 10), [4, 6, 8, 10])
+        eq_(path_between(DBSession, ancestry_tb, 10, 11),
+            [10, 8, 6, 4, 2, 1, 3, 9, 11])
+        eq_(path_between(DBSession, ancestry_tb, 10, 13), None)
@@ -0,0 +1,95 @@
+# -*- coding: UTF-8 -*-
+""""Testing several Hierarchy queries executed in one round trip"""
+from nose.tools import *
+
+from sqlalchemy import Table, Column, ForeignKey, MetaData
+from sqlalchemy import Integer, Unicode
+from sqlalchemy import select, event
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqla_hierarchy import *
+
+from tests import get_engine
+
+DBSession = scoped_session(sessionmaker())
+metadata = MetaData()
+engine = get_engine('pg-db')
+DBSession.configure(bind=engine)
+metadata.bind = engine
+
+batch_tb = Table('batch_hierarchy', metadata,
+                 Column('id', Integer, primary_key=True),
+                 Column('name', Unicode(10)),
+                 Column('parent_id', Integer,
+                        ForeignKey('batch_hierarchy.id'), index=True)
+                )
+
+category_tb = Table('batch_category', metadata,
+                    Column('code', Unicode(10), primary_key=True),
+                    Column('parent_code', Unicode(10),
+                           ForeignKey('batch_category.code'), index=True),
+                    Column('ordering', Integer)
+                   )
+
+batch_values = {1:None, 2:1, 3:1, 4:2, 5:3, 7:3, 9:3, 6:4, 11:9, 8:6,
+                10:8, 12:8}
+
+statements = []
+
+def _count(*args):
+    statements.append(args[2])
+
+def setup():
+    """The tree we use in test_pg plus a small category tree"""
+    metadata.drop_all()
+    metadata.create_all()
+    DBSession.execute(batch_tb.insert(),
+                      [{'id':k, 'name':u'item %d' % k, 'parent_id':v} \
+                       for k, v in sorted(batch_values.items())])
+    DBSession.execute(category_tb.insert(),
+                      [{'code':u'root', 'parent_code':None, 'ordering':1},
+                       {'code':u'b', 'parent_code':u'root', 'ordering':1},
+                       {'code':u'a', 'parent_code':u'root', 'ordering':2}])
+    DBSession.commit()
+    event.listen(engine, 'before_cursor_execute', _count)
+
+def teardown():
+    metadata.drop_all()
+
+class TestBatch(object):
+
+    def test1_execute_batch(self):
+        """Batch pgsql: every Hierarchy gets the same rows it returns alone,
+        with a single statement"""
+        qries = [Hierarchy(DBSession, batch_tb, select([batch_tb])),
+                 Hierarchy(DBSession, category_tb, select([category_tb])),
+                 Hierarchy(DBSession, batch_tb, select([batch_tb.c.id]),
+                           starting_node=3)]
+        expected = [DBSession.execute(v).fetchall() for v in qries]
+        del statements[:]
+        got = execute_batch(DBSession, qries)
+        eq_(len(statements), 1)
+        eq_(len(got), 3)
+        for rows, exp in zip(got, expected):
+            eq_(len(rows), len(exp))
+            for row, exp_row in zip(rows, exp):
+                for key in exp_row.keys():
+                    eq_(getattr(row, key), getattr(exp_row, key))
+        eq_([v.code for v in got[1]], [u'root', u'b', u'a'])
+        eq_(got[2][0].level, 1)
+
+    def test2_mixed_types(self):
+        """Batch pgsql: blocks of int, text, array and boolean columns from
+        more than 3 hierarchies are matched by the union"""
+        qries = [Hierarchy(DBSession, category_tb, select([category_tb])),
+                 Hierarchy(DBSession, batch_tb, select([batch_tb])),
+                 Hierarchy(DBSession, category_tb,
+                           select([category_tb.c.code]),
+                           starting_node=u'root'),
+                 Hierarchy(DBSession, batch_tb, select([batch_tb.c.id]),
+                           starting_node=8)]
+        got = execute_batch(DBSession, qries)
+        eq_([len(v) for v in got], [3, 12, 2, 2])
+        eq_(got[0][1].connect_path, [u'root', u'b'])
+        eq_(got[1][3].connect_path, [1, 2, 4, 6])
+        eq_([v.is_leaf for v in got[2]], [True, True])
+        eq_([v.id for v in got[3]], [10, 12])
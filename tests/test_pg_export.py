@@ -0,0 +1,100 @@
+# -*- coding: UTF-8 -*-
+""""Testing the columnar export of a Hierarchy"""
+from nose import SkipTest
+from nose.tools import *
+
+from sqlalchemy import Table, Column, ForeignKey, MetaData
+from sqlalchemy import Integer, Unicode
+from sqlalchemy import select
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqla_hierarchy import *
+
+from tests import get_engine
+
+try:
+    import numpy
+except ImportError:
+    raise SkipTest("numpy is not installed")
+
+DBSession = scoped_session(sessionmaker())
+metadata = MetaData()
+engine = get_engine('pg-db')
+DBSession.configure(bind=engine)
+metadata.bind = engine
+
+export_tb = Table('export_hierarchy', metadata,
+                  Column('id', Integer, primary_key=True),
+                  Column('name', Unicode(10)),
+                  Column('parent_id', Integer,
+                         ForeignKey('export_hierarchy.id'), index=True)
+                 )
+
+# siblings sharing an ordering value: pgsql returns 2 and 3 (in any order)
+# before their children, so the rows are not depth first
+tie_tb = Table('export_tie_hierarchy', metadata,
+               Column('id', Integer, primary_key=True),
+               Column('parent_id', Integer,
+                      ForeignKey('export_tie_hierarchy.id')),
+               Column('ordering', Integer, nullable=False)
+              )
+
+tie_values = {1:(None, 1), 2:(1, 1), 3:(1, 1), 4:(2, 2), 5:(3, 1)}
+
+export_values = {1:None, 2:1, 3:1, 4:2, 5:3, 7:3, 9:3, 6:4, 11:9, 8:6,
+                 10:8, 12:8}
+
+def setup():
+    """Same tree we use in test_pg"""
+    metadata.drop_all()
+    metadata.create_all()
+    DBSession.execute(export_tb.insert(),
+                      [{'id':k, 'name':u'item %d' % k, 'parent_id':v} \
+                       for k, v in sorted(export_values.items())])
+    DBSession.execute(tie_tb.insert(),
+                      [{'id':k, 'parent_id':v[0], 'ordering':v[1]} \
+                       for k, v in sorted(tie_values.items())])
+    DBSession.commit()
+
+def teardown():
+    metadata.drop_all()
+
+class TestExport(object):
+
+    def test1_arrays(self):
+        """Export pgsql: parent positions point to the parent ids"""
+        qry = Hierarchy(DBSession, export_tb, select([export_tb]))
+        arrays = hierarchy_arrays(DBSession, qry, batch_size=5)
+        eq_(len(arrays), 12)
+        eq_(arrays.id.dtype, numpy.int64)
+        for pos in range(len(arrays)):
+            parent = arrays.parent[pos]
+            if parent == -1:
+                eq_(export_values[arrays.id[pos]], None)
+            else:
+                eq_(export_values[arrays.id[pos]], arrays.id[parent])
+                eq_(arrays.level[pos], arrays.level[parent] + 1)
+        eq_(sorted(arrays.id[arrays.is_leaf].tolist()), [5,7,10,11,12])
+        eq_(arrays.preorder.tolist(), range(12))
+
+    def test2_filtered_parents(self):
+        """Export pgsql: rows whose parent was filtered out have no parent"""
+        qry = Hierarchy(DBSession, export_tb,
+                        select([export_tb], ~export_tb.c.id.in_([4, 6])),
+                        where_mode='filter')
+        arrays = hierarchy_arrays(DBSession, qry, batch_size=5)
+        eq_(arrays.id.tolist(), [1, 2, 8, 10, 12, 3, 5, 7, 9, 11])
+        parents = dict((arrays.id[pos], arrays.id[arrays.parent[pos]] \
+                        if arrays.parent[pos] >= 0 else None) \
+                       for pos in range(len(arrays)))
+        eq_(parents, {1:None, 2:1, 8:None, 10:8, 12:8, 3:1, 5:3, 7:3, 9:3,
+                      11:9})
+
+    def test3_not_depth_first(self):
+        """Export pgsql: mixed subtrees are reported instead of getting the
+        wrong parents"""
+        assert_raises(ValueError, hierarchy_arrays, DBSession,
+                      Hierarchy(DBSession, tie_tb, select([tie_tb])))
+        arrays = hierarchy_arrays(DBSession, Hierarchy(
+            DBSession, tie_tb, select([tie_tb]), path_encoding='binary'))
+        eq_(arrays.id[arrays.parent].tolist()[1:],
+            [tie_values[v][0] for v in arrays.id.tolist()[1:]])
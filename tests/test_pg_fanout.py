@@ -0,0 +1,92 @@
+# -*- coding: UTF-8 -*-
+""""Testing the max_children option of Hierarchy"""
+from nose.tools import *
+
+from sqlalchemy import Table, Column, ForeignKey, MetaData
+from sqlalchemy import Integer, Unicode
+from sqlalchemy import select
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqla_hierarchy import *
+
+from tests import get_engine
+
+DBSession = scoped_session(sessionmaker())
+metadata = MetaData()
+engine = get_engine('pg-db')
+DBSession.configure(bind=engine)
+metadata.bind = engine
+
+fanout_tb = Table('fanout_hierarchy', metadata,
+                  Column('id', Integer, primary_key=True),
+                  Column('name', Unicode(10)),
+                  Column('parent_id', Integer,
+                         ForeignKey('fanout_hierarchy.id'), index=True),
+                  Column('ordering', Integer)
+                 )
+
+# id: (parent_id, ordering)
+fanout_values = {1:(None, 1),
+                 2:(1, 5), 3:(1, 4), 4:(1, 3), 5:(1, 2), 6:(1, 1),
+                 7:(5, 2), 8:(5, 1), 9:(5, 3),
+                 10:(2, 1)}
+
+def setup():
+    """A root with a wide fan-out:
+        1
+          6
+          5
+            8
+            7
+            9
+          4
+          3
+          2
+            10
+    (children shown by their ordering)
+    """
+    fanout_tb.drop(checkfirst=True)
+    fanout_tb.create(checkfirst=True)
+    DBSession.execute(fanout_tb.insert(),
+                      [{'id':k, 'name':u'item %d' % k, 'parent_id':v[0],
+                        'ordering':v[1]} \
+                       for k, v in sorted(fanout_values.items())])
+    DBSession.commit()
+
+def teardown():
+    fanout_tb.drop(checkfirst=True)
+
+class TestMaxChildren(object):
+
+    def test1_max_children(self):
+        """Max children pgsql: only the first children of every node are
+        visited"""
+        qry = Hierarchy(DBSession, fanout_tb, select([fanout_tb]),
+                        max_children=2)
+        rs = DBSession.execute(qry).fetchall()
+        eq_([v.id for v in rs], [1, 6, 5, 8, 7])
+        eq_([v.id for v in rs if v.is_leaf], [6, 8, 7])
+
+    def test2_max_children_prune(self):
+        """Max children pgsql: the where clause is checked before limiting"""
+        qry = Hierarchy(DBSession, fanout_tb,
+                        select([fanout_tb], fanout_tb.c.id!=6),
+                        max_children=2)
+        rs = DBSession.execute(qry).fetchall()
+        eq_([v.id for v in rs], [1, 5, 8, 7, 4])
+
+    def test3_max_children_ties(self):
+        """Max children pgsql: siblings sharing an ordering value are picked
+        by id"""
+        DBSession.execute(fanout_tb.update(fanout_tb.c.id.in_([2, 3]),
+                                           values={'ordering':3}))
+        qry = Hierarchy(DBSession, fanout_tb, select([fanout_tb]),
+                        max_children=3)
+        rs = DBSession.execute(qry).fetchall()
+        eq_([v.id for v in rs], [1, 6, 5, 8, 7, 9, 2, 10])
+        DBSession.rollback()
+
+    def test4_max_children_invalid(self):
+        """Max children: only positive integers are accepted"""
+        for value in (0, -1, '2'):
+            assert_raises(ValueError, Hierarchy, DBSession, fanout_tb,
+                          select([fanout_tb]), max_children=value)
@@ -0,0 +1,135 @@
+# -*- coding: UTF-8 -*-
+""""Testing the incremental refresh of a cached Hierarchy"""
+from nose.tools import *
+
+from sqlalchemy import Table, Column, ForeignKey, MetaData
+from sqlalchemy import Integer, Unicode
+from sqlalchemy import select, event
+from sqlalchemy.orm import scoped_session, sessionmaker, mapper
+from sqla_hierarchy import *
+
+from tests import get_engine
+
+DBSession = scoped_session(sessionmaker())
+metadata = MetaData()
+engine = get_engine('pg-db')
+DBSession.configure(bind=engine)
+metadata.bind = engine
+
+incremental_tb = Table('incremental_hierarchy', metadata,
+                       Column('id', Integer, primary_key=True),
+                       Column('name', Unicode(10)),
+                       Column('parent_id', Integer,
+                              ForeignKey('incremental_hierarchy.id'),
+                              index=True)
+                      )
+
+# never created, the cache only looks at its columns
+ordered_tb = Table('incremental_ordered_hierarchy', metadata,
+                   Column('id', Integer, primary_key=True),
+                   Column('parent_id', Integer,
+                          ForeignKey('incremental_ordered_hierarchy.id')),
+                   Column('ordering', Integer)
+                  )
+
+class Node(object):
+    pass
+
+mapper(Node, incremental_tb)
+
+incremental_values = {1:None, 2:1, 3:1, 4:2, 5:3, 7:3, 9:3, 6:4, 11:9, 8:6,
+                      10:8, 12:8}
+
+statements = []
+
+def _count(*args):
+    statements.append(args[2])
+
+def setup():
+    """Create the table with the usual tree"""
+    incremental_tb.drop(checkfirst=True)
+    incremental_tb.create(checkfirst=True)
+    DBSession.execute(incremental_tb.insert(),
+                      [{'id':k, 'name':u'item %d' % k, 'parent_id':v} \
+                       for k, v in sorted(incremental_values.items())])
+    DBSession.commit()
+    event.listen(engine, 'before_cursor_execute', _count)
+
+def teardown():
+    DBSession.remove()
+    incremental_tb.drop(checkfirst=True)
+
+def hierarchy():
+    return Hierarchy(DBSession, incremental_tb, select([incremental_tb]))
+
+def fresh():
+    return [tuple(v) for v in DBSession.execute(hierarchy()).fetchall()]
+
+class TestIncremental(object):
+
+    def test1_move(self):
+        """Incremental pgsql: moving a subtree updates it and both parents"""
+        cache = HierarchyCache(hierarchy()).load(DBSession)
+        DBSession.execute(incremental_tb.update().where(
+            incremental_tb.c.id==8).values(parent_id=2))
+        delta = cache.refresh(DBSession, [8])
+        eq_(sorted([v.id for v in delta.updated]), [6, 8, 10, 12])
+        eq_(delta.inserted, [])
+        eq_(delta.removed, [])
+        eq_([tuple(v) for v in cache.ordered_rows()], fresh())
+        DBSession.rollback()
+
+    def test2_insert_delete(self):
+        """Incremental pgsql: inserted and deleted nodes"""
+        cache = HierarchyCache(hierarchy()).load(DBSession)
+        DBSession.execute(incremental_tb.delete().where(
+            incremental_tb.c.id==11))
+        DBSession.execute(incremental_tb.insert(),
+                          [{'id':13, 'name':u'item 13', 'parent_id':7},
+                           {'id':14, 'name':u'item 14', 'parent_id':13}])
+        delta = cache.refresh(DBSession, [11, 13, 14])
+        eq_(delta.removed, [11])
+        eq_(sorted([v.id for v in delta.inserted]), [13, 14])
+        eq_(sorted([v.id for v in delta.updated]), [7, 9])
+        eq_([tuple(v) for v in cache.ordered_rows()], fresh())
+        DBSession.rollback()
+
+    def test3_tracker(self):
+        """Incremental pgsql: ids collected from the flush"""
+        cache = HierarchyCache(hierarchy()).load(DBSession)
+        tracker = ChangeTracker(DBSession, incremental_tb)
+        node = DBSession.query(Node).get(5)
+        node.parent_id = 1
+        DBSession.flush()
+        eq_(tracker.pop(), set([5]))
+        delta = cache.refresh(DBSession, [5])
+        eq_([(v.id, v.level) for v in delta.updated], [(5, 2)])
+        eq_([tuple(v) for v in cache.ordered_rows()], fresh())
+        DBSession.rollback()
+
+    def test4_many_roots(self):
+        """Incremental pgsql: unrelated changes are refreshed with two
+        statements"""
+        cache = HierarchyCache(hierarchy()).load(DBSession)
+        DBSession.execute(incremental_tb.update().where(
+            incremental_tb.c.id==12).values(parent_id=5))
+        DBSession.execute(incremental_tb.update().where(
+            incremental_tb.c.id==11).values(name=u'renamed'))
+        DBSession.execute(incremental_tb.update().where(
+            incremental_tb.c.id==7).values(parent_id=4))
+        del statements[:]
+        delta = cache.refresh(DBSession, [12, 11, 7])
+        eq_(len(statements), 2)
+        eq_(sorted([v.id for v in delta.updated]), [5, 7, 11, 12])
+        eq_(cache.rows[11].name, u'renamed')
+        eq_([tuple(v) for v in cache.ordered_rows()], fresh())
+        DBSession.rollback()
+
+    def test5_unsupported(self):
+        """Incremental pgsql: options that can't be patched are rejected"""
+        assert_raises(NotImplementedError, HierarchyCache,
+                      Hierarchy(DBSession, incremental_tb,
+                                select([incremental_tb]), max_children=2))
+        # python would sort the null orderings differently than pgsql
+        assert_raises(NotImplementedError, HierarchyCache,
+                      Hierarchy(DBSession, ordered_tb, select([ordered_tb])))
@@ -0,0 +1,87 @@
+# -*- coding: UTF-8 -*-
+""""Testing the instrumentation of Hierarchy queries"""
+import warnings
+from nose.tools import *
+
+from sqlalchemy import Table, Column, ForeignKey, MetaData
+from sqlalchemy import Integer, Unicode
+from sqlalchemy import select
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqla_hierarchy import *
+
+from tests import get_engine
+
+DBSession = scoped_session(sessionmaker())
+metadata = MetaData()
+engine = get_engine('pg-db')
+DBSession.configure(bind=engine)
+metadata.bind = engine
+
+instr_tb = Table('instr_hierarchy', metadata,
+                 Column('id', Integer, primary_key=True),
+                 Column('name', Unicode(10)),
+                 Column('parent_id', Integer,
+                        ForeignKey('instr_hierarchy.id'), index=True)
+                )
+
+noindex_tb = Table('noindex_hierarchy', metadata,
+                   Column('id', Integer, primary_key=True),
+                   Column('parent_id', Integer,
+                          ForeignKey('noindex_hierarchy.id'))
+                  )
+
+instr_values = {1:None, 2:1, 3:1, 4:2, 5:3, 7:3, 9:3, 6:4, 11:9, 8:6,
+                10:8, 12:8}
+
+def setup():
+    """Same tree we use in test_pg"""
+    metadata.drop_all()
+    metadata.create_all()
+    DBSession.execute(instr_tb.insert(),
+                      [{'id':k, 'name':u'item %d' % k, 'parent_id':v} \
+                       for k, v in sorted(instr_values.items())])
+    DBSession.commit()
+
+def teardown():
+    metadata.drop_all()
+
+class TestInstrument(object):
+
+    def test1_stats(self):
+        """Instrument pgsql: rows per level and max depth"""
+        qry = Hierarchy(DBSession, instr_tb, select([instr_tb]))
+        got = []
+        rs, stats = execute_instrumented(DBSession, qry, callback=got.append)
+        eq_(len(rs), 12)
+        eq_(stats.rows, 12)
+        eq_(stats.rows_per_level, {1:1, 2:2, 3:4, 4:2, 5:1, 6:2})
+        eq_(stats.max_depth, 6)
+        ok_(stats.compile_time >= 0 and stats.execute_time >= 0)
+        eq_(got, [stats])
+
+    def test2_listener(self):
+        """Instrument pgsql: registered listeners get every execution"""
+        got = []
+        add_listener(got.append)
+        try:
+            qry = Hierarchy(DBSession, instr_tb, select([instr_tb]))
+            execute_instrumented(DBSession, qry)
+        finally:
+            remove_listener(got.append)
+        eq_(len(got), 1)
+        eq_(got[0].table, 'instr_hierarchy')
+
+    def test3_explain(self):
+        """Instrument pgsql: explain returns the plan"""
+        qry = Hierarchy(DBSession, instr_tb, select([instr_tb]))
+        plan = explain(DBSession, qry, analyze=True)
+        ok_([v for v in plan if 'Recursive Union' in v])
+
+    def test4_missing_index(self):
+        """Instrument pgsql: warn if the parent column has no index"""
+        qry = Hierarchy(DBSession, noindex_tb, select([noindex_tb]))
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always', HierarchyWarning)
+            execute_instrumented(DBSession, qry)
+        eq_(len(w), 1)
+        ok_(issubclass(w[0].category, HierarchyWarning))
@@ -0,0 +1,120 @@
+# -*- coding: UTF-8 -*-
+""""Testing the nested sets numbering and the hierarchies read from it"""
+from nose.tools import *
+
+from sqlalchemy import Table, Column, ForeignKey, MetaData
+from sqlalchemy import Integer, Unicode
+from sqlalchemy import select
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqla_hierarchy import *
+
+from tests import get_engine
+
+DBSession = scoped_session(sessionmaker())
+metadata = MetaData()
+engine = get_engine('pg-db')
+DBSession.configure(bind=engine)
+metadata.bind = engine
+
+nested_tb = Table('nested_hierarchy', metadata,
+                  Column('id', Integer, primary_key=True),
+                  Column('name', Unicode(10)),
+                  Column('parent_id', Integer,
+                         ForeignKey('nested_hierarchy.id'), index=True),
+                  Column('ordering', Integer)
+                 )
+
+nested_side_tb = nested_set_table(nested_tb)
+
+# siblings sharing an ordering value: pgsql returns 2 and 3 (in any order)
+# before their children, so the rows are not depth first
+tie_tb = Table('nested_tie_hierarchy', metadata,
+               Column('id', Integer, primary_key=True),
+               Column('parent_id', Integer,
+                      ForeignKey('nested_tie_hierarchy.id')),
+               Column('ordering', Integer, nullable=False)
+              )
+
+tie_side_tb = nested_set_table(tie_tb)
+
+tie_values = {1:(None, 1), 2:(1, 1), 3:(1, 1), 4:(2, 2), 5:(3, 1)}
+
+nested_values = {1:None, 2:1, 3:1, 4:2, 5:3, 7:3, 9:3, 6:4, 11:9, 8:6,
+                 10:8, 12:8}
+
+def setup():
+    """Create the table with the usual tree (ordered by id) and its side
+    table"""
+    metadata.drop_all()
+    metadata.create_all()
+    DBSession.execute(nested_tb.insert(),
+                      [{'id':k, 'name':u'item %d' % k, 'parent_id':v,
+                        'ordering':k} \
+                       for k, v in sorted(nested_values.items())])
+    DBSession.execute(tie_tb.insert(),
+                      [{'id':k, 'parent_id':v[0], 'ordering':v[1]} \
+                       for k, v in sorted(tie_values.items())])
+    DBSession.commit()
+
+def teardown():
+    metadata.drop_all()
+
+def rows(rs):
+    return [(v.id, v.level, v.connect_path, v.ordering_path, v.is_leaf) \
+            for v in rs]
+
+class TestNestedSets(object):
+
+    def test1_build(self):
+        """Nested sets pgsql: one pass numbering"""
+        eq_(build_nested_sets(DBSession, Hierarchy(
+            DBSession, nested_tb, select([nested_tb])), nested_side_tb,
+            batch_size=5), 12)
+        DBSession.commit()
+        rs = DBSession.execute(select([nested_side_tb]).order_by(
+            nested_side_tb.c.lft)).fetchall()
+        eq_([(v.id, v.lft, v.rgt) for v in rs][:4],
+            [(1, 1, 24), (2, 2, 13), (4, 3, 12), (6, 4, 11)])
+        eq_([v.id for v in rs if v.rgt==v.lft + 1], [10, 12, 5, 7, 11])
+        eq_(rs[5].connect_path, [1, 2, 4, 6, 8, 10])
+        assert_raises(ValueError, build_nested_sets, DBSession,
+                      Hierarchy(DBSession, nested_tb,
+                                select([nested_tb], nested_tb.c.id!=4),
+                                where_mode='filter'), nested_side_tb)
+
+    def test2_whole_tree(self):
+        """Nested sets pgsql: same rows as the recursive query"""
+        qry = Hierarchy(DBSession, nested_tb, select([nested_tb]),
+                        nested_sets=nested_side_tb)
+        eq_(rows(DBSession.execute(qry).fetchall()),
+            rows(DBSession.execute(Hierarchy(
+                DBSession, nested_tb, select([nested_tb]))).fetchall()))
+
+    def test3_subtree(self):
+        """Nested sets pgsql: subtree of a starting node"""
+        qry = Hierarchy(DBSession, nested_tb, select([nested_tb]),
+                        nested_sets=nested_side_tb, starting_node=3)
+        eq_(rows(DBSession.execute(qry).fetchall()),
+            rows(DBSession.execute(Hierarchy(
+                DBSession, nested_tb, select([nested_tb]),
+                starting_node=3)).fetchall()))
+
+    def test4_filter(self):
+        """Nested sets pgsql: the where clause filters the rows"""
+        qry = Hierarchy(DBSession, nested_tb,
+                        select([nested_tb], nested_tb.c.id > 6),
+                        nested_sets=nested_side_tb, where_mode='filter')
+        rs = DBSession.execute(qry).fetchall()
+        eq_([v.id for v in rs], [8, 10, 12, 7, 9, 11])
+        eq_(rs[0].connect_path, [1, 2, 4, 6, 8])
+        assert_raises(ValueError, Hierarchy, DBSession, nested_tb,
+                      select([nested_tb], nested_tb.c.id > 6),
+                      nested_sets=nested_side_tb)
+
+    def test5_not_depth_first(self):
+        """Nested sets pgsql: mixed subtrees are reported instead of getting
+        overlapping intervals"""
+        assert_raises(ValueError, build_nested_sets, DBSession,
+                      Hierarchy(DBSession, tie_tb, select([tie_tb])),
+                      tie_side_tb)
+        DBSession.rollback()
@@ -0,0 +1,90 @@
+# -*- coding: UTF-8 -*-
+""""Testing the ORM version of Hierarchy"""
+from nose.tools import *
+
+from sqlalchemy import Table, Column, ForeignKey, MetaData
+from sqlalchemy import Integer, Unicode
+from sqlalchemy import event
+from sqlalchemy.orm import mapper, relationship, backref
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqla_hierarchy import *
+
+from tests import get_engine
+
+DBSession = scoped_session(sessionmaker())
+metadata = MetaData()
+engine = get_engine('pg-db')
+DBSession.configure(bind=engine)
+metadata.bind = engine
+
+orm_tb = Table('orm_hierarchy', metadata,
+               Column('id', Integer, primary_key=True),
+               Column('name', Unicode(10)),
+               Column('parent_id', Integer, ForeignKey('orm_hierarchy.id'),
+                      index=True)
+              )
+
+class Node(object):
+    def __repr__(self):
+        return "Node<%d, %s>" %(self.id, self.parent_id)
+
+mapper(Node, orm_tb, properties = {
+       'parent': relationship(Node, remote_side=[orm_tb.c.id],
+                              backref=backref('children',
+                                              order_by=orm_tb.c.id.desc()))})
+
+orm_values = {1:None, 2:1, 3:1, 4:2, 5:3, 7:3, 9:3, 6:4, 11:9, 8:6,
+              10:8, 12:8}
+
+statements = []
+
+def _count(*args):
+    statements.append(args[2])
+
+def setup():
+    """Same tree we use in test_pg"""
+    orm_tb.drop(checkfirst=True)
+    orm_tb.create(checkfirst=True)
+    DBSession.execute(orm_tb.insert(),
+                      [{'id':k, 'name':u'item %d' % k, 'parent_id':v} \
+                       for k, v in sorted(orm_values.items())])
+    DBSession.commit()
+    event.listen(engine, 'before_cursor_execute', _count)
+
+def teardown():
+    DBSession.remove()
+    orm_tb.drop(checkfirst=True)
+
+class TestHierarchyQuery(object):
+
+    def setup(self):
+        DBSession.expunge_all()
+
+    def test1_instances(self):
+        """ORM pgsql: we get mapped instances in hierarchy order"""
+        nodes = hierarchy_query(DBSession, Node)
+        eq_(len(nodes), 12)
+        ok_(isinstance(nodes[0], Node))
+        eq_(nodes[0].id, 1)
+
+    def test2_no_lazy_loads(self):
+        """ORM pgsql: walking the loaded tree issues no SQL"""
+        nodes = hierarchy_query(DBSession, Node)
+        del statements[:]
+        for ev in nodes:
+            if ev.parent is not None:
+                eq_(ev.parent.id, orm_values[ev.id])
+            # the backref orders the children by id desc
+            eq_([v.id for v in ev.children],
+                sorted([k for k, v in orm_values.items() if v == ev.id],
+                       reverse=True))
+        eq_(statements, [])
+
+    def test3_starting_node(self):
+        """ORM pgsql: the parent of the starting node is left to the lazy
+        loader"""
+        nodes = hierarchy_query(DBSession, Node, starting_node=3)
+        eq_(sorted([v.id for v in nodes]), [5,7,9,11])
+        del statements[:]
+        eq_([v.id for v in nodes if v.id == 9][0].children[0].id, 11)
+        eq_(statements, [])
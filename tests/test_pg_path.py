@@ -0,0 +1,91 @@
+# -*- coding: UTF-8 -*-
+""""Testing path encodings with non integer keys and ordering columns"""
+from nose.tools import *
+
+from sqlalchemy import Table, Column, ForeignKey, MetaData
+from sqlalchemy import Unicode
+from sqlalchemy import select
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqla_hierarchy import *
+
+from tests import get_engine
+
+DBSession = scoped_session(sessionmaker())
+metadata = MetaData()
+engine = get_engine('pg-db')
+DBSession.configure(bind=engine)
+metadata.bind = engine
+
+path_tb = Table('path_hierarchy', metadata,
+                Column('code', Unicode(36), primary_key=True),
+                Column('parent_code', Unicode(36),
+                       ForeignKey('path_hierarchy.code'), index=True),
+                Column('ordering', Unicode(10))
+               )
+
+# code: (parent_code, ordering)
+path_values = {u'root': (None, u'a'),
+               u'zulu': (u'root', u'a'), u'alpha': (u'root', u'b'),
+               u'mike': (u'alpha', u'b'), u'bravo': (u'alpha', u'a'),
+               u'yankee': (u'zulu', u'a'),
+               u'other': (None, u'b')}
+
+def setup():
+    """A tree with text keys and a text ordering column:
+        root
+          zulu
+            yankee
+          alpha
+            bravo
+            mike
+        other
+    """
+    path_tb.drop(checkfirst=True)
+    path_tb.create(checkfirst=True)
+    DBSession.execute(path_tb.insert(),
+                      [{'code':k, 'parent_code':v[0], 'ordering':v[1]} \
+                       for k, v in sorted(path_values.items())])
+    DBSession.commit()
+
+def teardown():
+    path_tb.drop(checkfirst=True)
+
+expected = [u'root', u'zulu', u'yankee', u'alpha', u'bravo', u'mike',
+            u'other']
+
+class TestPathEncoding(object):
+
+    def test1_array(self):
+        """Path encoding pgsql: text ordering column with arrays"""
+        qry = Hierarchy(DBSession, path_tb, select([path_tb]))
+        rs = DBSession.execute(qry).fetchall()
+        eq_([v.code for v in rs], expected)
+        eq_(rs[3].ordering_path, [u'a', u'b'])
+
+    def test2_binary(self):
+        """Path encoding pgsql: binary paths keep the same order"""
+        qry = Hierarchy(DBSession, path_tb, select([path_tb]),
+                        path_encoding='binary')
+        rs = DBSession.execute(qry).fetchall()
+        eq_([v.code for v in rs], expected)
+        eq_([v.code for v in rs if v.is_leaf], [u'yankee', u'bravo',
+                                                 u'mike', u'other'])
+        eq_([len(v.sort_path) for v in rs], [4 * v.level for v in rs])
+        eq_(rs[2].connect_path, [u'root', u'zulu', u'yankee'])
+
+    def test3_binary_every_node(self):
+        """Path encoding pgsql: without a starting node every subtree keeps
+        its own binary paths"""
+        qry = Hierarchy(DBSession, path_tb, select([path_tb]),
+                        path_encoding='binary', starting_node=False)
+        rs = DBSession.execute(qry).fetchall()
+        eq_(len(rs), 15)
+        eq_(len(set([v.sort_path for v in rs])), 15)
+        leaves = [u'yankee', u'bravo', u'mike', u'other']
+        eq_(sorted(set([(v.code, v.is_leaf) for v in rs])),
+            sorted([(v, v in leaves) for v in path_values]))
+
+    def test4_wrong_encoding(self):
+        """Path encoding pgsql: unknown encodings are rejected"""
+        assert_raises(ValueError, Hierarchy, DBSession, path_tb,
+                      select([path_tb]), path_encoding='nope')
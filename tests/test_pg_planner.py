@@ -0,0 +1,96 @@
+# -*- coding: UTF-8 -*-
+""""Testing the strategy planner"""
+from nose.tools import *
+
+from sqlalchemy import Table, Column, ForeignKey, MetaData
+from sqlalchemy import Integer, Unicode
+from sqlalchemy import select
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqla_hierarchy import *
+
+from tests import get_engine
+
+DBSession = scoped_session(sessionmaker())
+metadata = MetaData()
+engine = get_engine('pg-db')
+DBSession.configure(bind=engine)
+metadata.bind = engine
+
+planner_tb = Table('planner_hierarchy', metadata,
+                   Column('id', Integer, primary_key=True),
+                   Column('name', Unicode(10)),
+                   Column('parent_id', Integer,
+                          ForeignKey('planner_hierarchy.id'), index=True)
+                  )
+
+# never created, the planner only looks at its columns
+ordered_tb = Table('planner_ordered_hierarchy', metadata,
+                   Column('id', Integer, primary_key=True),
+                   Column('parent_id', Integer,
+                          ForeignKey('planner_ordered_hierarchy.id')),
+                   Column('ordering', Integer)
+                  )
+
+def setup():
+    """A shallow tree: one root with 100 children, 3 of them with 100
+    children of their own"""
+    planner_tb.drop(checkfirst=True)
+    planner_tb.create(checkfirst=True)
+    values = [{'id':1, 'name':u'root', 'parent_id':None}]
+    values.extend([{'id':ev, 'name':u'item %d' % ev, 'parent_id':1} \
+                   for ev in range(2, 102)])
+    values.extend([{'id':ev, 'name':u'item %d' % ev,
+                    'parent_id':2 + (ev - 102) // 100} \
+                   for ev in range(102, 402)])
+    DBSession.execute(planner_tb.insert(), values)
+    DBSession.commit()
+
+def teardown():
+    planner_tb.drop(checkfirst=True)
+
+def rows(rs):
+    return [(v.id, v.level, v.connect_path, v.is_leaf) for v in rs]
+
+class TestPlanner(object):
+
+    def test1_shape(self):
+        """Planner pgsql: shape of the tree"""
+        shape = HierarchyPlanner().shape(DBSession, planner_tb)
+        eq_(shape.node_count, 401)
+        eq_(shape.max_depth, 3)
+        eq_(shape.fanout, {100:4})
+        ok_(shape.parent_indexed)
+
+    def test2_levels(self):
+        """Planner pgsql: shallow and wide trees are walked by levels"""
+        qry = Hierarchy(DBSession, planner_tb, select([planner_tb]))
+        rs, plan = HierarchyPlanner().execute(DBSession, qry)
+        eq_(plan.strategy, 'levels')
+        eq_(rows(rs), rows(DBSession.execute(qry).fetchall()))
+
+    def test3_override(self):
+        """Planner pgsql: the caller can choose the strategy"""
+        planner = HierarchyPlanner(levels_min_fanout=1000)
+        qry = Hierarchy(DBSession, planner_tb, select([planner_tb]))
+        eq_(planner.plan(DBSession, qry).strategy, 'recursive')
+        rs, plan = planner.execute(DBSession, qry, strategy='levels')
+        eq_(plan.strategy, 'levels')
+        eq_(len(rs), 401)
+        assert_raises(ValueError, planner.plan, DBSession, qry, 'snapshot')
+        assert_raises(ValueError, planner.plan, DBSession,
+                      Hierarchy(DBSession, planner_tb, select([planner_tb]),
+                                max_children=2), 'levels')
+        # python would sort the null orderings differently than pgsql
+        qry = Hierarchy(DBSession, ordered_tb, select([ordered_tb]))
+        eq_(planner.plan(DBSession, qry).strategy, 'recursive')
+        assert_raises(ValueError, planner.plan, DBSession, qry, 'levels')
+
+    def test4_snapshot(self):
+        """Planner pgsql: registered snapshots are served from memory"""
+        planner = HierarchyPlanner()
+        qry = Hierarchy(DBSession, planner_tb, select([planner_tb]))
+        planner.add_snapshot(DBSession, HierarchyCache(qry).load(DBSession))
+        rs, plan = planner.execute(DBSession, Hierarchy(
+            DBSession, planner_tb, select([planner_tb])))
+        eq_(plan.strategy, 'snapshot')
+        eq_(rows(rs), rows(DBSession.execute(qry).fetchall()))
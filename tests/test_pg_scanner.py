@@ -0,0 +1,72 @@
+# -*- coding: UTF-8 -*-
+""""Testing the tree profiler and integrity scanner"""
+from nose.tools import *
+
+from sqlalchemy import Table, Column, ForeignKey, MetaData
+from sqlalchemy import Integer, Unicode
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqla_hierarchy import *
+
+from tests import get_engine
+
+DBSession = scoped_session(sessionmaker())
+metadata = MetaData()
+engine = get_engine('pg-db')
+DBSession.configure(bind=engine)
+metadata.bind = engine
+
+scanner_tb = Table('scanner_hierarchy', metadata,
+                   Column('id', Integer, primary_key=True),
+                   Column('name', Unicode(10)),
+                   Column('parent_id', Integer,
+                          ForeignKey('scanner_hierarchy.id'), index=True)
+                  )
+
+# the same table without the foreign key constraint, so we can store rows
+# that break the tree
+broken_metadata = MetaData()
+broken_metadata.bind = engine
+broken_tb = Table('scanner_hierarchy', broken_metadata,
+                  Column('id', Integer, primary_key=True),
+                  Column('name', Unicode(10)),
+                  Column('parent_id', Integer, index=True)
+                 )
+
+scanner_values = {1:None, 2:1, 3:1, 4:2, 5:3, 7:3, 9:3, 6:4, 11:9, 8:6,
+                  10:8, 12:8,
+                  # orphans
+                  13:99, 14:13,
+                  # a cycle and a chain hanging from it
+                  15:17, 16:15, 17:16, 18:16, 19:18}
+
+def setup():
+    """The usual tree plus two orphans and a cycle"""
+    broken_tb.drop(checkfirst=True)
+    broken_tb.create(checkfirst=True)
+    DBSession.execute(broken_tb.insert(),
+                      [{'id':k, 'name':u'item %d' % k, 'parent_id':v} \
+                       for k, v in sorted(scanner_values.items())])
+    DBSession.commit()
+
+def teardown():
+    broken_tb.drop(checkfirst=True)
+
+class TestScanner(object):
+
+    def test1_shape(self):
+        """Scanner pgsql: depth histogram, fan-out and largest subtrees"""
+        profile = scan_tree(DBSession, scanner_tb, top=3)
+        eq_(profile.node_count, 19)
+        eq_(profile.depth_histogram, {1:1, 2:2, 3:4, 4:2, 5:1, 6:2})
+        eq_(profile.max_depth, 6)
+        eq_(profile.fanout_percentiles[100], 3)
+        eq_(profile.largest_subtrees, [(1, 12), (2, 6), (3, 5)])
+
+    def test2_integrity(self):
+        """Scanner pgsql: orphans and cycles"""
+        profile = scan_tree(DBSession, scanner_tb)
+        ok_(not profile.ok)
+        eq_(profile.orphan_count, 1)
+        eq_(profile.orphans, [13])
+        eq_(profile.cycles, [[15, 17, 16]])
+        eq_(profile.unreachable, 5)
@@ -0,0 +1,91 @@
+# -*- coding: UTF-8 -*-
+""""Testing the memory mapped snapshots of a Hierarchy"""
+import os
+import shutil
+import tempfile
+
+from nose import SkipTest
+from nose.tools import *
+
+from sqlalchemy import Table, Column, ForeignKey, MetaData
+from sqlalchemy import Integer, Unicode
+from sqlalchemy import select
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqla_hierarchy import *
+
+from tests import get_engine
+
+try:
+    import numpy
+except ImportError:
+    raise SkipTest("numpy is not installed")
+
+DBSession = scoped_session(sessionmaker())
+metadata = MetaData()
+engine = get_engine('pg-db')
+DBSession.configure(bind=engine)
+metadata.bind = engine
+
+snapshot_tb = Table('snapshot_hierarchy', metadata,
+                    Column('id', Integer, primary_key=True),
+                    Column('name', Unicode(10)),
+                    Column('parent_id', Integer,
+                           ForeignKey('snapshot_hierarchy.id'), index=True)
+                   )
+
+snapshot_values = {1:None, 2:1, 3:1, 4:2, 5:3, 7:3, 9:3, 6:4, 11:9, 8:6,
+                   10:8, 12:8}
+
+directory = None
+
+def setup():
+    """Same tree we use in test_pg and a directory for the snapshots"""
+    global directory
+    directory = tempfile.mkdtemp()
+    snapshot_tb.drop(checkfirst=True)
+    snapshot_tb.create(checkfirst=True)
+    DBSession.execute(snapshot_tb.insert(),
+                      [{'id':k, 'name':u'item %d' % k, 'parent_id':v} \
+                       for k, v in sorted(snapshot_values.items())])
+    DBSession.commit()
+
+def teardown():
+    snapshot_tb.drop(checkfirst=True)
+    shutil.rmtree(directory)
+
+def hierarchy():
+    return Hierarchy(DBSession, snapshot_tb, select([snapshot_tb]))
+
+class TestSnapshot(object):
+
+    def test1_read(self):
+        """Snapshot pgsql: write and map a snapshot"""
+        path = os.path.join(directory, 'read.snap')
+        eq_(write_snapshot(DBSession, hierarchy(), path), 12)
+        snap = HierarchySnapshot(path)
+        eq_(len(snap), 12)
+        eq_(snap.children(3), [5, 7, 9])
+        eq_(snap.ancestors(10), [1, 2, 4, 6, 8])
+        eq_([snap.node_id(v) for v in snap.subtree(6)], [8, 10, 12])
+        eq_(list(snap.level[:3]), [1, 2, 3])
+        ok_(not snap.parent.flags.writeable)
+        assert_raises(KeyError, snap.position, 99)
+        assert_raises(ValueError, write_snapshot, DBSession,
+                      Hierarchy(DBSession, snapshot_tb,
+                                select([snapshot_tb], snapshot_tb.c.id!=4),
+                                where_mode='filter'), path)
+
+    def test2_swap(self):
+        """Snapshot pgsql: readers move to a new version with reload"""
+        path = os.path.join(directory, 'swap.snap')
+        write_snapshot(DBSession, hierarchy(), path)
+        snap = HierarchySnapshot(path)
+        ok_(not snap.reload())
+        DBSession.execute(snapshot_tb.update().where(
+            snapshot_tb.c.id==9).values(parent_id=2))
+        write_snapshot(DBSession, hierarchy(), path)
+        DBSession.rollback()
+        ok_(snap.is_stale())
+        ok_(snap.reload())
+        eq_(snap.children(3), [5, 7])
+        eq_(os.listdir(directory).count('swap.snap'), 1)
@@ -0,0 +1,114 @@
+# -*- coding: UTF-8 -*-
+""""Testing set based subtree operations"""
+from nose.tools import *
+
+from sqlalchemy import Table, Column, ForeignKey, MetaData
+from sqlalchemy import Integer, Unicode
+from sqlalchemy import select
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqla_hierarchy import *
+
+from tests import get_engine
+
+DBSession = scoped_session(sessionmaker())
+metadata = MetaData()
+engine = get_engine('pg-db')
+DBSession.configure(bind=engine)
+metadata.bind = engine
+
+subtree_tb = Table('subtree_hierarchy', metadata,
+                   Column('id', Integer, primary_key=True),
+                   Column('name', Unicode(10)),
+                   Column('parent_id', Integer,
+                          ForeignKey('subtree_hierarchy.id'), index=True)
+                  )
+
+# column names that must be quoted
+quoted_tb = Table('quoted_hierarchy', metadata,
+                  Column('nodeId', Integer, primary_key=True),
+                  Column('parentId', Integer,
+                         ForeignKey('quoted_hierarchy.nodeId'))
+                 )
+
+subtree_values = {1:None, 2:1, 3:1, 4:2, 5:3, 7:3, 9:3, 6:4, 11:9, 8:6,
+                  10:8, 12:8}
+
+def setup():
+    """Same tree we use in test_pg:
+        1
+          2
+            4
+              6
+                8
+                  10
+                  12
+          3
+            5
+            7
+            9
+              11
+    """
+    metadata.drop_all()
+    metadata.create_all()
+
+def teardown():
+    metadata.drop_all()
+
+def _load():
+    DBSession.rollback()
+    DBSession.execute(subtree_tb.delete())
+    DBSession.execute(subtree_tb.insert(),
+                      [{'id':k, 'name':u'item %d' % k, 'parent_id':v} \
+                       for k, v in sorted(subtree_values.items())])
+
+def _ids():
+    return sorted([v[0] for v in \
+                   DBSession.execute(select([subtree_tb.c.id])).fetchall()])
+
+class TestSubtree(object):
+
+    def setup(self):
+        _load()
+
+    def teardown(self):
+        DBSession.rollback()
+
+    def test1_delete(self):
+        """Subtree pgsql: delete a whole branch in one statement"""
+        eq_(delete_subtree(DBSession, subtree_tb, 4), 5)
+        eq_(_ids(), [1,2,3,5,7,9,11])
+
+    def test2_move(self):
+        """Subtree pgsql: re-parent a branch"""
+        eq_(move_subtree(DBSession, subtree_tb, 9, 2), 1)
+        qry = Hierarchy(DBSession, subtree_tb, select([subtree_tb]),
+                        starting_node=2)
+        eq_(sorted([v.id for v in DBSession.execute(qry).fetchall()]),
+            [4,6,8,9,10,11,12])
+
+    def test3_move_cycle(self):
+        """Subtree pgsql: moving a node below its own descendant fails"""
+        assert_raises(HierarchyCycleError, move_subtree, DBSession,
+                      subtree_tb, 2, 8)
+        eq_(DBSession.execute(select([subtree_tb.c.parent_id],
+                                     subtree_tb.c.id==2)).scalar(), 1)
+        eq_(move_subtree(DBSession, subtree_tb, 99, 8), 0)
+
+    def test4_copy(self):
+        """Subtree pgsql: copy a branch remapping its ids"""
+        offset = copy_subtree(DBSession, subtree_tb, 9, 5)
+        eq_(offset, 12 - 9 + 1)
+        rs = DBSession.execute(select([subtree_tb.c.id,
+                                       subtree_tb.c.parent_id],
+                                      subtree_tb.c.id>12)).fetchall()
+        eq_(sorted([tuple(v) for v in rs]), [(13, 5), (15, 13)])
+
+    def test5_quoted(self):
+        """Subtree pgsql: column names are quoted"""
+        DBSession.execute(quoted_tb.insert(),
+                          [{'nodeId':k, 'parentId':v} \
+                           for k, v in sorted(subtree_values.items())])
+        eq_(move_subtree(DBSession, quoted_tb, 9, 2), 1)
+        assert_raises(HierarchyCycleError, move_subtree, DBSession,
+                      quoted_tb, 2, 11)
+        eq_(delete_subtree(DBSession, quoted_tb, 2), 8)
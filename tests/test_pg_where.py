@@ -0,0 +1,87 @@
+# -*- coding: UTF-8 -*-
+""""Testing the different ways to apply a where clause to a Hierarchy"""
+from nose.tools import *
+
+from sqlalchemy import Table, Column, ForeignKey, MetaData
+from sqlalchemy import Integer, Unicode, Boolean
+from sqlalchemy import select
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqla_hierarchy import *
+
+from tests import get_engine
+
+DBSession = scoped_session(sessionmaker())
+metadata = MetaData()
+engine = get_engine('pg-db')
+DBSession.configure(bind=engine)
+metadata.bind = engine
+
+where_tb = Table('where_hierarchy', metadata,
+                 Column('id', Integer, primary_key=True),
+                 Column('name', Unicode(10)),
+                 Column('parent_id', Integer,
+                        ForeignKey('where_hierarchy.id'), index=True),
+                 Column('active', Boolean, default=True, nullable=False)
+                )
+
+where_values = {1:None, 2:1, 3:1, 4:2, 5:3, 7:3, 9:3, 6:4, 11:9, 8:6,
+                10:8, 12:8}
+
+def setup():
+    """Same tree we use in test_pg, but 3 and 11 are not active:
+        1
+          2
+            4
+              6
+                8
+                  10
+                  12
+          3 (inactive)
+            5
+            7
+            9
+              11 (inactive)
+    """
+    where_tb.drop(checkfirst=True)
+    where_tb.create(checkfirst=True)
+    DBSession.execute(where_tb.insert(),
+                      [{'id':k, 'name':u'item %d' % k, 'parent_id':v,
+                        'active':k not in (3, 11)} \
+                       for k, v in sorted(where_values.items())])
+    DBSession.commit()
+
+def teardown():
+    where_tb.drop(checkfirst=True)
+
+def _run(where_mode):
+    qry = Hierarchy(DBSession, where_tb,
+                    select([where_tb.c.id], where_tb.c.active==True),
+                    where_mode=where_mode)
+    return DBSession.execute(qry).fetchall()
+
+class TestWhereMode(object):
+
+    def test1_prune(self):
+        """Where mode pgsql: prune removes the inactive subtrees"""
+        eq_(sorted([v.id for v in _run('prune')]), [1,2,4,6,8,10,12])
+
+    def test2_anchor(self):
+        """Where mode pgsql: anchor only checks the starting nodes"""
+        eq_(sorted([v.id for v in _run('anchor')]), range(1, 13))
+
+    def test3_filter(self):
+        """Where mode pgsql: filter walks the full tree and filters the
+        output"""
+        rs = _run('filter')
+        eq_(sorted([v.id for v in rs]), [1,2,4,5,6,7,8,9,10,12])
+        for ev in rs:
+            if ev.id == 9:
+                eq_(ev.level, 3)
+                eq_(ev.connect_path, [1, 3, 9])
+                # 11 is filtered out, but 9 is still its parent
+                eq_(ev.is_leaf, False)
+
+    def test4_wrong_mode(self):
+        """Where mode pgsql: unknown modes are rejected"""
+        assert_raises(ValueError, Hierarchy, DBSession, where_tb,
+                      select([where_tb]), where_mode='nope')